@@ -4,16 +4,35 @@ Provides the majority of the logic in the charm, specifically all logic which
 can be meaningfully unit tested.
 """
 try:
+    from urllib.error import HTTPError, URLError
     from urllib.parse import urlparse
+    from urllib.request import urlopen
 except ImportError:
+    from urllib2 import HTTPError, URLError, urlopen
     from urlparse import urlparse
 
+import concurrent.futures
+import contextlib
 import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import json
 import os
+import re
+import shutil
 import socket
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 
-from charmhelpers.core import hookenv, host, templating, unitdata
+import yaml
+
+from charmhelpers.core import hookenv, host, sysctl, templating, unitdata
 from charmhelpers.fetch import apt_install, apt_update, add_source, ubuntu_apt_pkg
 
 from charms.reactive.flags import _get_flag_value
@@ -24,6 +43,28 @@ from reactive.layer_backup import Backup as BackupHelper
 import semantic_version
 
 
+class RailsQueryError(Exception):
+    """Raised when a query to the Rails query server fails."""
+
+
+class RedisError(Exception):
+    """Raised when Redis replies to a command with an error."""
+
+
+def timed_operation(operation):
+    """Decorate a GitlabHelper method to record its duration and outcome in the operational metrics."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.operation_timer(operation):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class GitlabHelper:
     """The GitLab helper class.
 
@@ -33,6 +74,150 @@ class GitlabHelper:
 
     package_name = "gitlab-ce"
     gitlab_config = "/etc/gitlab/gitlab.rb"
+    apt_proxy_config = "/etc/apt/apt.conf.d/42juju-gitlab-proxy"
+    sysctl_config = "/etc/sysctl.d/50-juju-gitlab.conf"
+    # services writing to the database, stopped while restoring a backup
+    restore_services = ["puma", "sidekiq"]
+    # read only queries answered by the long-lived Rails query server
+    rails_queries = [
+        "runner_token",
+        "application_settings",
+        "background_migrations",
+    ]
+    rails_query_script = "/etc/gitlab/juju-rails-query-server.rb"
+    rails_query_socket = "/var/opt/gitlab/gitlab-rails/sockets/juju-rails-query.socket"
+    rails_query_boot_timeout = 300
+    # seconds to wait for DNS when resolving the unit's FQDN
+    fqdn_timeout = 5
+    # health checks run on update-status, cached for health_cache_ttl seconds
+    health_timeout = 5
+    health_slow_ms = 1000
+    health_cache_ttl = 60
+    backlog_queues_shown = 3
+    # Sidekiq's keys in Redis, namespaced by older GitLab releases
+    sidekiq_namespaces = ["resque:gitlab:", ""]
+    # exporters enabled for the scrape relation, alongside the Rails /-/metrics endpoint
+    metrics_ports = {
+        "gitlab-sidekiq": 8082,
+        "gitaly": 9236,
+        "gitlab-workhorse": 9229,
+        "gitlab-exporter": 9168,
+    }
+    monitoring_whitelist = ["127.0.0.0/8", "::1/128"]
+    # histogram buckets in seconds for the operational metrics textfile
+    operation_buckets = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+    metrics_textfile = "juju_gitlab.prom"
+    # verified GitLab packages from the gitlab-package resource
+    package_cache_dir = "/var/cache/juju-gitlab/packages"
+    package_cache_size = 2
+    # omnibus settings covered by the tuning profiles, keyed by the charm option overriding them
+    tuning_settings = {
+        "puma_workers": "puma['worker_processes']",
+        "puma_min_threads": "puma['min_threads']",
+        "puma_max_threads": "puma['max_threads']",
+        "sidekiq_concurrency": "sidekiq['concurrency']",
+        "db_pool": "gitlab_rails['db_pool']",
+        "gitaly_ruby_workers": "gitaly['ruby_num_workers']",
+        "nginx_workers": "nginx['worker_processes']",
+        "nginx_worker_connections": "nginx['worker_connections']",
+        "puma_per_worker_max_memory_mb": "puma['per_worker_max_memory_mb']",
+    }
+    # bounds of the automatic Puma worker memory limit in MB, from GitLab's stock limit
+    puma_worker_memory_limits = (1024, 2048)
+    # single node settings sized after GitLab's reference architectures
+    tuning_profiles = {
+        "small": {
+            "puma_workers": 2,
+            "puma_min_threads": 4,
+            "puma_max_threads": 4,
+            "sidekiq_concurrency": 10,
+            "gitaly_ruby_workers": 2,
+            "nginx_workers": 2,
+            "nginx_worker_connections": 1024,
+        },
+        "medium": {
+            "puma_workers": 4,
+            "puma_min_threads": 4,
+            "puma_max_threads": 4,
+            "sidekiq_concurrency": 15,
+            "gitaly_ruby_workers": 3,
+            "nginx_workers": 4,
+            "nginx_worker_connections": 4096,
+        },
+        "large": {
+            "puma_workers": 8,
+            "puma_min_threads": 4,
+            "puma_max_threads": 4,
+            "sidekiq_concurrency": 20,
+            "gitaly_ruby_workers": 4,
+            "nginx_workers": 8,
+            "nginx_worker_connections": 10240,
+        },
+        "xlarge": {
+            "puma_workers": 16,
+            "puma_min_threads": 4,
+            "puma_max_threads": 4,
+            "sidekiq_concurrency": 25,
+            "gitaly_ruby_workers": 6,
+            "nginx_workers": 16,
+            "nginx_worker_connections": 10240,
+        },
+    }
+    # CPU cores and GB of RAM tuning_profile=auto requires before choosing each profile
+    tuning_profile_minimums = {
+        "small": (0, 0),
+        "medium": (8, 16),
+        "large": (16, 32),
+        "xlarge": (32, 64),
+    }
+    # runit services of the optional omnibus components, keyed by component
+    component_services = {
+        "pages": ["gitlab-pages"],
+        "registry": ["registry"],
+        "kas": ["gitlab-kas"],
+        "mattermost": ["mattermost"],
+        "monitoring": ["prometheus", "alertmanager", "node-exporter", "grafana"],
+    }
+    # bundled exporters for services the charm relates to instead
+    disabled_services = ["redis-exporter", "postgres-exporter"]
+    # the diagnose action writes its tarballs here
+    diagnostics_dir = "/var/opt/gitlab/diagnostics"
+    # omnibus' repository storage on the root disk, kept alongside attached volumes
+    default_git_data_dir = "/var/opt/gitlab/git-data"
+    repository_storage_weight = 100
+    # rendered from the Ruby runtime options, merged with any gitlab_rb_overrides entry
+    rails_env_key = "gitlab_rails['env']"
+    # application settings for how many pushes trigger each housekeeping task
+    housekeeping_settings = [
+        "housekeeping_incremental_repack_period",
+        "housekeeping_full_repack_period",
+        "housekeeping_gc_period",
+    ]
+    housekeeping_script = "/etc/gitlab/juju-housekeeping.rb"
+    # omnibus paths moved onto the artifacts, lfs, uploads and backups storage, keyed by storage name
+    data_storage_paths = {
+        "artifacts": "gitlab_rails['artifacts_path']",
+        "lfs": "gitlab_rails['lfs_storage_path']",
+        "uploads": "gitlab_rails['uploads_directory']",
+        "backups": "gitlab_rails['backup_path']",
+    }
+    # names used in the unit status for readiness checks and omnibus services
+    component_names = {
+        "master_check": "Puma",
+        "db_check": "PostgreSQL",
+        "cache_check": "Redis cache",
+        "queues_check": "Redis queues",
+        "shared_state_check": "Redis shared state",
+        "gitaly_check": "Gitaly",
+        "puma": "Puma",
+        "unicorn": "Unicorn",
+        "sidekiq": "Sidekiq",
+        "gitaly": "Gitaly",
+        "gitlab-workhorse": "Workhorse",
+        "gitlab-exporter": "GitLab exporter",
+        "nginx": "nginx",
+        "logrotate": "logrotate",
+    }
 
     def __init__(self):
         """Load hookenv key/value store and charm configuration."""
@@ -45,6 +230,8 @@ class GitlabHelper:
         self.kv = unitdata.kv()
         self.gitlab_commands_file = "/etc/gitlab/commands.load"
         self.distro = host.get_distrib_codename()
+        self._network_identity = None
+        self._started = time.time()
 
     def set_package_name(self, name):
         """Parse and set the package name used to install and upgrade GitLab."""
@@ -74,7 +261,7 @@ class GitlabHelper:
         if configured_value:
             return configured_value
         else:
-            fqdn = "http://{}".format(socket.getfqdn())
+            fqdn = "http://{}".format(self.get_fqdn())
             return fqdn
 
     def get_sshhost(self):
@@ -84,7 +271,7 @@ class GitlabHelper:
         if url.hostname:
             return url.hostname
         else:
-            return socket.getfqdn()
+            return self.get_fqdn()
 
     def get_sshport(self):
         """Return the host used when configuring SSH access to GitLab."""
@@ -114,11 +301,11 @@ class GitlabHelper:
         else:
             port = 80
 
+        internal_host = None
         if self.charm_config["proxy_via_ip"]:
-            networks = hookenv.network_get(proxy.relation_name)
-            internal_host = networks["ingress-addresses"][0]
-        else:
-            internal_host = socket.getfqdn()
+            internal_host = self.get_binding_address(proxy.relation_name)
+        if not internal_host:
+            internal_host = self.get_fqdn()
 
         proxy_config = [
             {
@@ -137,6 +324,283 @@ class GitlabHelper:
         ]
         proxy.configure(proxy_config)
 
+    def gitlab_rails_run(self, script):
+        """Run a Ruby script with gitlab-rails runner, returning its output."""
+        cmd = ["/usr/bin/gitlab-rails", "runner", "-e", "production", script]
+        return subprocess.check_output(cmd).decode("utf-8")
+
+    def send_rails_query(self, name, timeout=30):
+        """Send a query to the Rails query server, returning its result."""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        try:
+            client.connect(self.rails_query_socket)
+            client.sendall("{}\n".format(name).encode("utf-8"))
+            response = b""
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                response += data
+        finally:
+            client.close()
+        if name == "shutdown":
+            return None
+        if not response:
+            raise RailsQueryError("No response from Rails query server")
+        response = json.loads(response.decode("utf-8"))
+        if "error" in response:
+            raise RailsQueryError(response["error"])
+        return response["result"]
+
+    def start_rails_query_server(self, wait=True):
+        """Start the Rails query server in the background, by default waiting for it to accept queries."""
+        hookenv.log("Starting Rails query server on {}".format(self.rails_query_socket))
+        # a server which exited uncleanly leaves its socket behind
+        if os.path.exists(self.rails_query_socket):
+            os.remove(self.rails_query_socket)
+        templating.render(
+            "rails-query-server.rb.j2",
+            self.rails_query_script,
+            {
+                "socket_path": self.rails_query_socket,
+                "idle_timeout": self.charm_config.get("rails_query_idle_timeout"),
+            },
+            perms=0o644,
+        )
+        subprocess.Popen(
+            [
+                "/usr/bin/gitlab-rails",
+                "runner",
+                "-e",
+                "production",
+                self.rails_query_script,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        if not wait:
+            return
+        deadline = time.time() + self.rails_query_boot_timeout
+        while time.time() < deadline:
+            if os.path.exists(self.rails_query_socket):
+                return
+            time.sleep(1)
+        raise RailsQueryError("Rails query server did not start")
+
+    def stop_rails_query_server(self):
+        """Stop the Rails query server if it is running, so the next query loads current code."""
+        try:
+            self.send_rails_query("shutdown")
+        except OSError:
+            pass
+
+    def rails_query(self, name, wait=True):
+        """Run a whitelisted query against GitLab via the warm Rails query server.
+
+        The server is started on first use, and exits after being idle for
+        rails_query_idle_timeout seconds. Without wait, a query which would
+        have to wait for Rails to boot raises RailsQueryError instead.
+        """
+        if name not in self.rails_queries:
+            raise RailsQueryError("Unknown Rails query {}".format(name))
+        try:
+            return self.send_rails_query(name)
+        except OSError:
+            if not wait:
+                self.start_rails_query_server(wait=False)
+                raise RailsQueryError("Rails query server is starting")
+            self.start_rails_query_server()
+        return self.send_rails_query(name)
+
+    def get_runner_token(self):
+        """Return the runner registration token.
+
+        The token is cached in the KV store, so the Rails query server is only
+        asked for it after the cache is invalidated.
+        """
+        token = self.kv.get("runner_token")
+        if not token:
+            hookenv.log("Fetching runner registration token from GitLab")
+            token = self.rails_query("runner_token")
+            self.kv.set("runner_token", token)
+        return token
+
+    def invalidate_runner_token(self):
+        """Remove the cached runner registration token, so it is fetched again on next use."""
+        self.kv.unset("runner_token")
+
+    def check_runner_token(self):
+        """Compare the cached runner registration token with GitLab's, replacing it when stale.
+
+        Returns True if the cached token no longer matched, so runners are
+        republished with the current token.
+        """
+        cached = self.kv.get("runner_token")
+        token = self.rails_query("runner_token")
+        if token == cached:
+            return False
+        hookenv.log("Cached runner registration token is stale, replacing it", hookenv.WARNING)
+        self.kv.set("runner_token", token)
+        return True
+
+    def refresh_runner_token(self, rotate=False):
+        """Fetch the runner registration token again, optionally rotating it first.
+
+        Runners are republished with the new token by the next hook.
+        """
+        if rotate:
+            hookenv.log("Rotating runner registration token")
+            self.gitlab_rails_run(
+                "Gitlab::CurrentSettings.current_application_settings.reset_runners_registration_token!"
+            )
+        self.invalidate_runner_token()
+        token = self.get_runner_token()
+        self.kv.unset("runner_published")
+        return token
+
+    def resolve_fqdn(self):
+        """Resolve the unit's FQDN, returning None if DNS does not answer within fqdn_timeout seconds."""
+        result = []
+        resolver = threading.Thread(target=lambda: result.append(socket.getfqdn()))
+        resolver.daemon = True
+        resolver.start()
+        resolver.join(self.fqdn_timeout)
+        if result:
+            return result[0]
+        hookenv.log(
+            "Resolving the unit FQDN timed out after {}s".format(self.fqdn_timeout),
+            hookenv.WARNING,
+        )
+        return None
+
+    def get_network_identity(self):
+        """Return the unit's FQDN and the binding addresses looked up so far.
+
+        The identity is resolved at most once per hook, and cached in the KV
+        store until the unit's private address changes. When DNS times out the
+        last known FQDN, or the hostname, is used and resolution is retried in
+        the next hook.
+        """
+        if self._network_identity is not None:
+            return self._network_identity
+        address = hookenv.unit_private_ip()
+        identity = self.kv.get("network_identity") or {}
+        if identity.get("address") != address or not identity.get("resolved"):
+            fqdn = self.resolve_fqdn()
+            identity = {
+                "address": address,
+                "fqdn": fqdn or identity.get("fqdn") or socket.gethostname(),
+                "resolved": fqdn is not None,
+                "bindings": {},
+            }
+            self.kv.set("network_identity", identity)
+        self._network_identity = identity
+        return identity
+
+    def invalidate_network_identity(self):
+        """Forget the cached network identity, so it is resolved again."""
+        self._network_identity = None
+        self.kv.unset("network_identity")
+
+    def get_fqdn(self):
+        """Return the unit's FQDN."""
+        return self.get_network_identity()["fqdn"]
+
+    def get_binding_address(self, endpoint_name):
+        """Return the ingress address of an endpoint's binding, or None when it is unavailable."""
+        identity = self.get_network_identity()
+        if not identity["bindings"].get(endpoint_name):
+            identity["bindings"][endpoint_name] = self.lookup_binding_address(
+                endpoint_name
+            )
+            self.kv.set("network_identity", identity)
+        return identity["bindings"][endpoint_name]
+
+    def lookup_binding_address(self, endpoint_name):
+        """Look up the ingress address of an endpoint's binding with network-get."""
+        try:
+            networks = hookenv.network_get(endpoint_name)
+        except (NotImplementedError, OSError, subprocess.CalledProcessError) as e:
+            hookenv.log(
+                "Unable to get the network for {}: {}".format(endpoint_name, e),
+                hookenv.WARNING,
+            )
+            return None
+        addresses = (networks or {}).get("ingress-addresses") or []
+        if addresses:
+            return addresses[0]
+        return None
+
+    def get_runner_uri(self):
+        """Return the URI runners use to register with GitLab.
+
+        When bypassing the proxy, the ingress address of the runner relation
+        binding is used so runners connect over the network they are related
+        on, falling back to the unit's FQDN.
+        """
+        if self.charm_config["runners_bypass_proxy"]:
+            host = self.get_binding_address("runner") or self.get_fqdn()
+            if self.charm_config["http_port"] != 80:
+                host = "{}:{}".format(host, self.charm_config["http_port"])
+            return "http://{}".format(host)
+        return self.get_external_uri()
+
+    def publish_runner_config(self, endpoint):
+        """Publish the runner configuration to every runner relation which has not yet received it.
+
+        Each relation is tracked in the KV store along with the units and the
+        configuration published to it, so new units, new relations and a
+        changed URI or token are all handled in one pass. Returns the IDs of
+        the relations published to.
+        """
+        uri = self.get_runner_uri()
+        token = self.get_runner_token()
+        published = self.kv.get("runner_published", {})
+        pending = {}
+        for relation in endpoint.relations:
+            units = sorted(unit.unit_name for unit in relation.joined_units)
+            record = published.get(relation.relation_id, {})
+            if (
+                record.get("uri") != uri
+                or record.get("token") != token
+                or not set(units).issubset(record.get("units", []))
+            ):
+                pending[relation.relation_id] = {
+                    "uri": uri,
+                    "token": token,
+                    "units": units,
+                }
+        if not pending:
+            return []
+        hookenv.log(
+            "Publishing runner config uri {} to {}".format(
+                uri, ", ".join(sorted(pending))
+            ),
+            hookenv.DEBUG,
+        )
+        endpoint.publish(uri, token)
+        published.update(pending)
+        self.kv.set("runner_published", published)
+        return sorted(pending)
+
+    def forget_departed_runners(self, endpoint):
+        """Stop tracking runner relations and units which have departed."""
+        current = {
+            relation.relation_id: [unit.unit_name for unit in relation.joined_units]
+            for relation in endpoint.relations
+        }
+        published = {}
+        for relation_id, record in self.kv.get("runner_published", {}).items():
+            if relation_id in current:
+                record["units"] = [
+                    unit for unit in record["units"] if unit in current[relation_id]
+                ]
+                published[relation_id] = record
+        self.kv.set("runner_published", published)
+
     def mysql_configured(self):
         """Determine if we have MySQL DB configuration present."""
         if (
@@ -169,39 +633,313 @@ class GitlabHelper:
         hookenv.log("Installing pgloader...", hookenv.INFO)
         apt_install("pgloader", fatal=True)
 
-    def configure_pgloader(self):
-        """Render templated commands.load file for pgloader to self.gitlab_commands_file."""
+    def get_pgloader_settings(self, overrides=None):
+        """Return pgloader tuning settings sized to the unit's cores and RAM.
+
+        Numeric overrides other than None or 0 replace the automatic value,
+        boolean overrides can only disable a feature. Override keys may use the
+        hyphenated action parameter names.
+        """
+        cores = os.cpu_count() or 1
+        ram_mb = host.get_total_ram() // (1024 * 1024)
+        workers = max(2, min(cores, 16))
+        settings = {
+            "workers": workers,
+            "concurrency": max(1, workers // 4),
+            "batch_rows": 50000 if ram_mb >= 8192 else 25000,
+            "batch_size": max(4, min(ram_mb // 256, 64)),
+            # keep roughly a quarter of RAM for prefetched rows, at ~2kB per row
+            "prefetch_rows": max(
+                10000, min(ram_mb * 1024 // 4 // (workers * 2), 100000)
+            ),
+            "multiple_readers": cores > 1,
+            "rows_per_range": 50000,
+        }
+        for key, value in (overrides or {}).items():
+            key = key.replace("-", "_")
+            if key not in settings or value is None:
+                continue
+            if isinstance(value, bool):
+                settings[key] = settings[key] and value
+            elif value:
+                settings[key] = value
+        return settings
+
+    def install_mysql_client(self):
+        """Install the MySQL client used to verify the migrated data."""
+        hookenv.log("Installing MySQL client...", hookenv.INFO)
+        apt_install("mysql-client", fatal=True)
+
+    def configure_pgloader(self, pgloader_options=None, tables=None, truncate=None):
+        """Render templated commands.load file for pgloader to self.gitlab_commands_file.
+
+        When tables is given, only those tables are loaded. The truncate
+        tables are emptied in a single TRUNCATE ... CASCADE before loading.
+        """
         hookenv.log(
             "Rendering pgloader commands.load file to /etc/gitlab", hookenv.INFO
         )
-        templating.render(
-            "commands.load.j2",
-            self.gitlab_commands_file,
-            {
-                "pgsql_host": self.kv.get("pgsql_host"),
-                "pgsql_port": self.kv.get("pgsql_port"),
-                "pgsql_database": self.kv.get("pgsql_db"),
-                "pgsql_user": self.kv.get("pgsql_user"),
-                "pgsql_password": self.kv.get("pgsql_pass"),
-                "mysql_host": self.kv.get("mysql_host"),
-                "mysql_port": self.kv.get("mysql_port"),
-                "mysql_database": self.kv.get("mysql_db"),
-                "mysql_user": self.kv.get("mysql_user"),
-                "mysql_password": self.kv.get("mysql_pass"),
-            },
-        )
-        if any_file_changed([self.gitlab_commands_file]):
-            self.run_pgloader()
+        context = {
+            "pgsql_host": self.kv.get("pgsql_host"),
+            "pgsql_port": self.kv.get("pgsql_port"),
+            "pgsql_database": self.kv.get("pgsql_db"),
+            "pgsql_user": self.kv.get("pgsql_user"),
+            "pgsql_password": self.kv.get("pgsql_pass"),
+            "mysql_host": self.kv.get("mysql_host"),
+            "mysql_port": self.kv.get("mysql_port"),
+            "mysql_database": self.kv.get("mysql_db"),
+            "mysql_user": self.kv.get("mysql_user"),
+            "mysql_password": self.kv.get("mysql_pass"),
+            "tables": tables or [],
+            "truncate": truncate or [],
+        }
+        settings = self.get_pgloader_settings(pgloader_options)
+        hookenv.log("Using pgloader settings: {}".format(settings), hookenv.INFO)
+        context.update(settings)
+        templating.render("commands.load.j2", self.gitlab_commands_file, context)
+
+    def log_progress(self, message):
+        """Log a progress message, also adding it to the action log when run from an action."""
+        hookenv.log(message, hookenv.INFO)
+        if hookenv.action_name():
+            subprocess.call(["action-log", message])
+
+    def parse_pgloader_summary(self, line):
+        """Return (table, errors, rows) from a pgloader summary line, or None for any other line."""
+        fields = line.split()
+        if len(fields) < 3 or not (fields[1].isdigit() and fields[2].isdigit()):
+            return None
+        table = fields[0].split(".")[-1].strip('"')
+        return table, int(fields[1]), int(fields[2])
 
     def run_pgloader(self):
-        """Run pgloader to migrate the data."""
+        """Run pgloader to migrate the data, streaming its output to the logs.
+
+        Returns the errors and rows per table from the pgloader summary.
+        """
         hookenv.log("Running pgloader", hookenv.INFO)
-        self.render_config()
-        # force a reconfigure as well
-        self.gitlab_reconfigure_run()
-        subprocess.check_output(
-            ["/usr/bin/pgloader", self.gitlab_commands_file], stderr=subprocess.STDOUT
+        cmd = ["/usr/bin/pgloader", self.gitlab_commands_file]
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        summary = {}
+        for line in process.stdout:
+            hookenv.log(line.rstrip(), hookenv.DEBUG)
+            result = self.parse_pgloader_summary(line)
+            if result:
+                table, errors, rows = result
+                summary[table] = {"errors": errors, "rows": rows}
+                self.log_progress(
+                    "Migrated table {}: {} rows, {} errors".format(table, rows, errors)
+                )
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return summary
+
+    def pgsql_client(self):
+        """Return the psql command and environment used to query the related PostgreSQL database."""
+        env = os.environ.copy()
+        env["PGPASSWORD"] = self.kv.get("pgsql_pass")
+        command = [
+            "/opt/gitlab/bin/psql",
+            "-h",
+            self.kv.get("pgsql_host"),
+            "-p",
+            str(self.kv.get("pgsql_port")),
+            "-U",
+            self.kv.get("pgsql_user"),
+            "-d",
+            self.kv.get("pgsql_db"),
+            "-A",
+            "-t",
+            "-F",
+            "\t",
+            "-c",
+        ]
+        return command, env
+
+    def mysql_client(self):
+        """Return the mysql command and environment used to query the related MySQL database."""
+        env = os.environ.copy()
+        env["MYSQL_PWD"] = self.kv.get("mysql_pass")
+        command = [
+            "/usr/bin/mysql",
+            "-h",
+            self.kv.get("mysql_host"),
+            "-P",
+            str(self.kv.get("mysql_port")),
+            "-u",
+            self.kv.get("mysql_user"),
+            "-D",
+            self.kv.get("mysql_db"),
+            "-N",
+            "-B",
+            "-e",
+        ]
+        return command, env
+
+    def run_query(self, client, query, timeout=None):
+        """Run a query with a database client from pgsql_client or mysql_client, returning rows as lists of columns."""
+        command, env = client
+        output = subprocess.check_output(command + [query], env=env, timeout=timeout)
+        return [line.split("\t") for line in output.decode("utf-8").splitlines()]
+
+    def pgsql_query(self, query):
+        """Run a query against the related PostgreSQL database, returning rows as lists of columns."""
+        return self.run_query(self.pgsql_client(), query)
+
+    def mysql_query(self, query):
+        """Run a query against the related MySQL database, returning rows as lists of columns."""
+        return self.run_query(self.mysql_client(), query)
+
+    def analyze_pgsql(self, vacuum=False):
+        """Collect planner statistics for the PostgreSQL database, optionally vacuuming as well."""
+        if vacuum:
+            self.pgsql_query("VACUUM ANALYZE")
+        else:
+            self.pgsql_query("ANALYZE")
+
+    def verify_row_counts(self, concurrency=None):
+        """Compare row counts of the migrated tables between MySQL and PostgreSQL.
+
+        Tables are counted concurrently, by up to concurrency threads which
+        defaults to the number of CPU cores.
+        """
+        mysql = self.mysql_client()
+        pgsql = self.pgsql_client()
+        mysql_tables = set(row[0] for row in self.run_query(mysql, "SHOW TABLES"))
+        tables = [
+            table
+            for table in self.kv.get("mysql_migrated_tables", [])
+            if table in mysql_tables
+        ]
+
+        # the KV store can't be used from the worker threads
+        def count_rows(client, query, table):
+            return int(self.run_query(client, query.format(table))[0][0])
+
+        workers = concurrency or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            mysql_counts = executor.map(
+                lambda table: count_rows(mysql, "SELECT COUNT(*) FROM `{}`", table),
+                tables,
+            )
+            pgsql_counts = executor.map(
+                lambda table: count_rows(pgsql, 'SELECT COUNT(*) FROM "{}"', table),
+                tables,
+            )
+            counts = {
+                table: {"mysql": mysql_count, "pgsql": pgsql_count}
+                for table, mysql_count, pgsql_count in zip(
+                    tables, mysql_counts, pgsql_counts
+                )
+            }
+        mismatched = sorted(
+            table for table, count in counts.items() if count["mysql"] != count["pgsql"]
         )
+        return {"tables": counts, "mismatched": mismatched}
+
+    def finish_migration(self, options):
+        """Analyze the migrated database and verify its row counts against MySQL.
+
+        The verification report is stored in the KV store. Tables with
+        mismatched row counts are marked for migration again, and False is
+        returned. Both are flushed so the next migratedb run sees them.
+        """
+        analyze = options.get("analyze") or "analyze"
+        if analyze != "none":
+            hookenv.status_set("maintenance", "Analyzing migrated PostgreSQL database")
+            self.log_progress("Running {} on PostgreSQL".format(analyze))
+            self.analyze_pgsql(vacuum=analyze == "vacuum-analyze")
+        hookenv.status_set("maintenance", "Verifying migrated row counts")
+        report = self.verify_row_counts(options.get("verify-concurrency"))
+        self.kv.set("mysql_migration_report", report)
+        self.kv.flush()
+        self.log_progress(
+            "Verified row counts for {} tables, {} mismatched".format(
+                len(report["tables"]), len(report["mismatched"])
+            )
+        )
+        if report["mismatched"]:
+            self.kv.set(
+                "mysql_migrated_tables",
+                [
+                    table
+                    for table in self.kv.get("mysql_migrated_tables", [])
+                    if table not in report["mismatched"]
+                ],
+            )
+            self.kv.flush()
+            self.log_progress(
+                "Row counts differ, run migratedb again to reload: {}".format(
+                    ", ".join(report["mismatched"])
+                )
+            )
+            hookenv.status_set(
+                "blocked",
+                "{} tables have mismatched row counts, run migratedb again to retry.".format(
+                    len(report["mismatched"])
+                ),
+            )
+            return False
+        return True
+
+    def get_pending_migration_tables(self):
+        """Return the tables in the GitLab schema which have not yet been migrated from MySQL.
+
+        Pending tables are truncated with CASCADE before loading, which also
+        empties any table referencing them by foreign key, so those tables
+        are migrated again as well.
+        """
+        migrated = self.kv.get("mysql_migrated_tables", [])
+        rows = self.pgsql_query(
+            "SELECT tablename FROM pg_tables WHERE schemaname = 'public' ORDER BY tablename"
+        )
+        references = self.pgsql_query(
+            "SELECT source.relname, target.relname FROM pg_constraint"
+            " JOIN pg_class source ON source.oid = pg_constraint.conrelid"
+            " JOIN pg_class target ON target.oid = pg_constraint.confrelid"
+            " WHERE pg_constraint.contype = 'f'"
+        )
+        pending = set(row[0] for row in rows if row[0] not in migrated)
+        added = True
+        while added:
+            referencing = set(source for source, target in references if target in pending)
+            added = referencing - pending
+            pending |= referencing
+        return [row[0] for row in rows if row[0] in pending]
+
+    def migrate_tables(self, tables, pgloader_options=None, tables_per_run=25):
+        """Migrate tables with pgloader in batches, recording each completed table in the KV store.
+
+        Returns the tables which failed to migrate cleanly. Raises
+        CalledProcessError if pgloader fails.
+        """
+        failed = []
+        for index in range(0, len(tables), tables_per_run):
+            batch = tables[index:index + tables_per_run]
+            hookenv.status_set(
+                "maintenance",
+                "Migrating tables {}-{} of {} via pgloader".format(
+                    index + 1, index + len(batch), len(tables)
+                ),
+            )
+            # the first run empties every pending table at once, as TRUNCATE
+            # rejects tables referenced by tables outside the statement
+            self.configure_pgloader(pgloader_options, batch, None if index else tables)
+            summary = self.run_pgloader()
+            migrated = self.kv.get("mysql_migrated_tables", [])
+            for table in batch:
+                if summary.get(table, {}).get("errors"):
+                    failed.append(table)
+                else:
+                    migrated.append(table)
+            self.kv.set("mysql_migrated_tables", migrated)
+            self.kv.flush()
+        return failed
 
     def mysql_migrated(self):
         """Return the contents of the mysql_migration_run KV entry which is set when migration completes."""
@@ -210,22 +948,50 @@ class GitlabHelper:
         else:
             return False
 
-    def migrate_db(self):
-        """Migrate DB contents from MySQL to PostgreSQL."""
+    def migrate_db(self, options=None):
+        """Migrate DB contents from MySQL to PostgreSQL.
+
+        Tables already migrated by a previous run are skipped, unless the
+        restart option is set. Other options are passed to pgloader, see
+        get_pgloader_settings.
+        """
         if self.mysql_configured() and self.pgsql_configured():
+            options = options or {}
             hookenv.log("Migrating database from MySQL to PostgreSQL", hookenv.INFO)
             hookenv.status_set("maintenance", "Starting MySQL to PostgreSQL migration")
             hookenv.status_set("maintenance", "Ensuring pgloader is installed")
             self.install_pgloader()
-            hookenv.status_set(
-                "maintenance", "Rendering pgloader configuration for migration"
-            )
-            self.configure_pgloader()
-            hookenv.status_set(
-                "maintenance",
-                "MySQL to PostgreSQL migration in progress via pgloader...",
-            )
-            self.run_pgloader()
+            self.install_mysql_client()
+            if options.get("restart"):
+                self.kv.unset("mysql_migrated_tables")
+            # make sure the GitLab schema exists in PostgreSQL before loading data
+            self.render_config()
+            self.gitlab_reconfigure_run()
+            tables = self.get_pending_migration_tables()
+            self.log_progress("{} tables left to migrate".format(len(tables)))
+            try:
+                failed = self.migrate_tables(
+                    tables, options, options.get("tables-per-run") or 25
+                )
+            except subprocess.CalledProcessError as e:
+                self.log_progress("pgloader failed, run migratedb again to retry: {}".format(e))
+                hookenv.status_set("blocked", "pgloader failed, run migratedb again to retry.")
+                return False
+            if failed:
+                self.log_progress(
+                    "Tables with errors, run migratedb again to retry: {}".format(
+                        ", ".join(failed)
+                    )
+                )
+                hookenv.status_set(
+                    "blocked",
+                    "{} tables failed to migrate, run migratedb again to retry.".format(
+                        len(failed)
+                    ),
+                )
+                return False
+            if not self.finish_migration(options):
+                return False
             hookenv.log(
                 "Migrated database from MySQL to PostgreSQL, running configure.",
                 hookenv.INFO,
@@ -235,6 +1001,9 @@ class GitlabHelper:
                 "Please remove the MySQL relation now migration is complete.",
             )
             self.kv.set("mysql_migration_run", True)
+            self.kv.flush()
+            return True
+        return False
 
     def migrate_mysql_config(self):
         """Migrate legacy MySQL configuration to new DB configuration in KV store."""
@@ -362,15 +1131,37 @@ class GitlabHelper:
         )
         add_source(apt_line, apt_key)
 
+    def configure_apt_proxy(self):
+        """Write or remove the APT proxy settings used when fetching GitLab and PostgreSQL packages.
+
+        The settings are an apt.conf.d drop-in, so they apply to every apt_update
+        and apt_install run by the charm.
+        """
+        proxies = [
+            (scheme, self.charm_config.get("apt_{}_proxy".format(scheme)))
+            for scheme in ("http", "https")
+        ]
+        lines = [
+            'Acquire::{}::Proxy "{}";'.format(scheme, proxy)
+            for scheme, proxy in proxies
+            if proxy
+        ]
+        if lines:
+            host.write_file(self.apt_proxy_config, "\n".join(lines + [""]).encode("utf-8"), perms=0o644)
+        elif os.path.exists(self.apt_proxy_config):
+            os.remove(self.apt_proxy_config)
+
     def add_sources(self):
         """Install all APT sources."""
+        self.configure_apt_proxy()
         self.add_gitlab_sources()
         self.add_pgsql_sources()
 
     def fetch_gitlab_apt_package(self):
         """Return reference to GitLab package information in the APT cache."""
         self.add_sources()
-        apt_update()
+        with self.operation_timer("apt_update"):
+            apt_update()
         apt_cache = ubuntu_apt_pkg.Cache()
         hookenv.log("Fetching package information for {}".format(self.package_name))
         package = False
@@ -420,15 +1211,178 @@ class GitlabHelper:
         return installed_version
 
     def gitlab_reconfigure_run(self):
-        """Run gitlab-ctl reconfigure."""
-        try:
-            subprocess.check_output(
-                ["/usr/bin/gitlab-ctl", "reconfigure"], stderr=subprocess.STDOUT
-            )
-        except subprocess.CalledProcessError:
-            return False
+        """Run gitlab-ctl reconfigure, invalidating the cached runner registration token."""
+        self.invalidate_runner_token()
+        with self.operation_timer("reconfigure") as operation:
+            try:
+                subprocess.check_output(
+                    ["/usr/bin/gitlab-ctl", "reconfigure"], stderr=subprocess.STDOUT
+                )
+            except subprocess.CalledProcessError:
+                operation["success"] = False
+                return False
         return True
 
+    def gitlab_ctl(self, command, service=None):
+        """Run a gitlab-ctl command, optionally limited to a single service."""
+        cmd = ["/usr/bin/gitlab-ctl", command]
+        if service:
+            cmd.append(service)
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+    @contextlib.contextmanager
+    def timed_phase(self, timings, phase):
+        """Record the duration in seconds of the wrapped block in timings[phase]."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            timings[phase] = round(time.time() - started, 3)
+
+    @contextlib.contextmanager
+    def operation_timer(self, operation):
+        """Record the duration and outcome of the wrapped block in the operational metrics.
+
+        The block fails if it raises, or if it sets success to False in the yielded dict.
+        """
+        state = {"success": True}
+        started = time.time()
+        try:
+            yield state
+        except Exception:
+            state["success"] = False
+            raise
+        finally:
+            self.record_operation(operation, time.time() - started, state["success"])
+
+    def watch_hook(self):
+        """Record the duration and outcome of the current hook when it exits.
+
+        charms.reactive only runs hookenv.atexit callbacks once a hook has
+        succeeded, so failures are recorded from sys.excepthook, which runs
+        for the exception failing the hook.
+        """
+        hookenv.atexit(self.record_hook, True)
+        excepthook = sys.excepthook
+
+        def record_failure(*exc_info):
+            try:
+                self.record_hook(False)
+            finally:
+                excepthook(*exc_info)
+
+        sys.excepthook = record_failure
+
+    def record_hook(self, success):
+        """Record the duration and outcome of the current hook.
+
+        A failed hook's changes to the KV store are never committed by
+        charms.reactive, so they are rolled back, keeping the operations it
+        recorded, and the failure is committed on its own.
+        """
+        if success:
+            self.record_operation("hook:{}".format(hookenv.hook_name()), time.time() - self._started, True)
+            return
+        metrics = self.kv.get("operation_metrics")
+        self.kv.flush(save=False)
+        if metrics is not None:
+            self.kv.set("operation_metrics", metrics)
+        self.record_operation("hook:{}".format(hookenv.hook_name()), time.time() - self._started, False)
+        self.kv.flush()
+
+    def record_operation(self, operation, duration, success):
+        """Add an operation's duration and outcome to the metrics in the KV store and write the textfile."""
+        metrics = self.kv.get("operation_metrics", {})
+        metric = metrics.setdefault(
+            operation,
+            {
+                "buckets": [0] * len(self.operation_buckets),
+                "sum": 0,
+                "count": 0,
+                "outcomes": {"success": 0, "failure": 0},
+                "last_success": None,
+            },
+        )
+        for index, bound in enumerate(self.operation_buckets):
+            if duration <= bound:
+                metric["buckets"][index] += 1
+        metric["sum"] = round(metric["sum"] + duration, 3)
+        metric["count"] += 1
+        metric["outcomes"]["success" if success else "failure"] += 1
+        if success:
+            metric["last_success"] = int(time.time())
+        self.kv.set("operation_metrics", metrics)
+        self.write_metrics_textfile(metrics)
+
+    def render_operation_metrics(self, metrics):
+        """Return the operational metrics in the Prometheus text exposition format."""
+        unit = hookenv.local_unit()
+        histogram = "juju_gitlab_operation_duration_seconds"
+        lines = [
+            "# HELP {} Duration of charm operations.".format(histogram),
+            "# TYPE {} histogram".format(histogram),
+        ]
+        for operation, metric in sorted(metrics.items()):
+            labels = 'unit="{}",operation="{}"'.format(unit, operation)
+            for bound, count in zip(self.operation_buckets, metric["buckets"]):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(histogram, labels, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(histogram, labels, metric["count"]))
+            lines.append("{}_sum{{{}}} {}".format(histogram, labels, metric["sum"]))
+            lines.append("{}_count{{{}}} {}".format(histogram, labels, metric["count"]))
+        lines.extend(
+            [
+                "# HELP juju_gitlab_operations_total Charm operations by outcome.",
+                "# TYPE juju_gitlab_operations_total counter",
+            ]
+        )
+        for operation, metric in sorted(metrics.items()):
+            for outcome, count in sorted(metric["outcomes"].items()):
+                lines.append(
+                    'juju_gitlab_operations_total{{unit="{}",operation="{}",outcome="{}"}} {}'.format(
+                        unit, operation, outcome, count
+                    )
+                )
+        lines.extend(
+            [
+                "# HELP juju_gitlab_operation_last_success_timestamp_seconds Time an operation last succeeded.",
+                "# TYPE juju_gitlab_operation_last_success_timestamp_seconds gauge",
+            ]
+        )
+        for operation, metric in sorted(metrics.items()):
+            if metric["last_success"]:
+                lines.append(
+                    'juju_gitlab_operation_last_success_timestamp_seconds{{unit="{}",operation="{}"}} {}'.format(
+                        unit, operation, metric["last_success"]
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_metrics_textfile(self, metrics):
+        """Atomically replace the node-exporter textfile with the operational metrics.
+
+        Nothing is written unless the configured textfile collector directory exists.
+        """
+        directory = self.charm_config.get("metrics_textfile_dir")
+        if not directory or not os.path.isdir(directory):
+            return
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".{}.".format(self.metrics_textfile), delete=False
+        ) as textfile:
+            textfile.write(self.render_operation_metrics(metrics))
+        os.chmod(textfile.name, 0o644)
+        os.replace(textfile.name, os.path.join(directory, self.metrics_textfile))
+
+    def set_action_results(self, results, prefix=""):
+        """Set action results, flattening nested dictionaries into dotted keys."""
+        flattened = {}
+        for key, value in results.items():
+            if isinstance(value, dict):
+                self.set_action_results(value, "{}{}.".format(prefix, key))
+            else:
+                flattened["{}{}".format(prefix, key)] = value
+        if flattened:
+            hookenv.action_set(flattened)
+
     def install_pgclient(self):
         """Install the latest supported PostgreSQL client, and symlink into place."""
         apt_install("postgresql-client-12")
@@ -446,13 +1400,142 @@ class GitlabHelper:
                 os.remove(binary_dest_path)
                 os.symlink(binary_path, binary_dest_path)
 
+    def file_sha256(self, path):
+        """Return the SHA-256 checksum of a file."""
+        checksum = hashlib.sha256()
+        with open(path, "rb") as package:
+            for chunk in iter(lambda: package.read(1024 * 1024), b""):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def get_deb_fields(self, path):
+        """Return the package name, version and architecture of a .deb file."""
+        output = subprocess.check_output(
+            ["dpkg-deb", "--field", path, "Package", "Version", "Architecture"]
+        ).decode("utf-8")
+        fields = dict(line.split(": ", 1) for line in output.splitlines() if ": " in line)
+        return fields["Package"], fields["Version"], fields["Architecture"]
+
+    def get_dpkg_version(self):
+        """Return the installed version of the GitLab package, or None if it isn't installed."""
+        try:
+            output = subprocess.check_output(
+                ["dpkg-query", "--show", "--showformat=${Version}", self.package_name],
+                stderr=subprocess.STDOUT,
+            )
+        except subprocess.CalledProcessError:
+            return None
+        return output.decode("utf-8").strip() or None
+
+    def import_package_resource(self):
+        """Verify the gitlab-package resource and copy it into the local package cache.
+
+        The resource is only hashed again once it changes, and is only used
+        when package_sha256 is set and matches it. Returns the path of the
+        cached package, or None without a usable resource.
+        """
+        path = (hookenv.resource_get("gitlab-package") or "").strip()
+        if not path or not os.path.isfile(path) or not os.path.getsize(path):
+            return None
+        stat = os.stat(path)
+        resource = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+        imported = self.kv.get("package_resource", {})
+        if imported.get("resource") == resource:
+            return imported["cached"]
+        expected = self.charm_config.get("package_sha256")
+        if not expected:
+            hookenv.log("Ignoring gitlab-package resource, set package_sha256 to install it", hookenv.ERROR)
+            return None
+        sha256 = self.file_sha256(path)
+        if expected.strip().lower() != sha256:
+            hookenv.log(
+                "Ignoring gitlab-package resource with SHA-256 {}, expected {}".format(sha256, expected),
+                hookenv.ERROR,
+            )
+            return None
+        name, version, arch = self.get_deb_fields(path)
+        if name != self.package_name:
+            hookenv.log(
+                "Ignoring gitlab-package resource for {}, {} is in use".format(name, self.package_name),
+                hookenv.WARNING,
+            )
+            return None
+        host.mkdir(self.package_cache_dir, perms=0o755)
+        cached = os.path.join(self.package_cache_dir, "{}_{}_{}.deb".format(name, version, arch))
+        shutil.copyfile(path, cached)
+        packages = self.kv.get("package_cache", {})
+        packages[cached] = {"name": name, "version": version, "sha256": sha256, "imported": time.time()}
+        self.prune_package_cache(packages)
+        self.kv.set("package_cache", packages)
+        self.kv.set("package_resource", {"resource": resource, "cached": cached})
+        hookenv.log("Cached gitlab-package resource {} {} as {}".format(name, version, cached))
+        return cached
+
+    def prune_package_cache(self, packages):
+        """Remove all but the package_cache_size most recently imported packages from the cache."""
+        by_age = sorted(packages, key=lambda path: packages[path]["imported"], reverse=True)
+        for path in by_age[self.package_cache_size:]:
+            hookenv.log("Removing {} from the package cache".format(path))
+            del packages[path]
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_package_target(self, version=None):
+        """Return the exact package version an install of an apt version or wildcard resolves to, or None.
+
+        That is the version option when it's set, otherwise apt's candidate,
+        as long as it matches the requested version. None is returned when
+        the target isn't known, e.g. for an intermediate major upgrade.
+        """
+        target = self.charm_config.get("version")
+        if not target:
+            try:
+                target = ubuntu_apt_pkg.Cache()[self.package_name].version
+            except KeyError:
+                return None
+        if not target or (version and not fnmatch.fnmatch(target, version)):
+            return None
+        return target
+
+    def get_cached_package(self, version):
+        """Return the verified package in the local cache with exactly the given version, or None.
+
+        Returns None when no cached package matches, or when it would
+        downgrade the installed package.
+        """
+        self.import_package_resource()
+        for path, package in sorted(self.kv.get("package_cache", {}).items()):
+            if package["name"] != self.package_name or package["version"] != version:
+                continue
+            if not os.path.exists(path) or self.file_sha256(path) != package["sha256"]:
+                hookenv.log("Cached package {} failed verification".format(path), hookenv.WARNING)
+                continue
+            installed = self.get_dpkg_version()
+            if installed and ubuntu_apt_pkg.version_compare(version, installed) < 0:
+                return None
+            return path
+        return None
+
+    @timed_operation("upgrade_package")
     def upgrade_package(self, version=None):
-        """Upgrade GitLab to a specific version given an apt package version or wildcard."""
-        if version:
+        """Upgrade GitLab to a specific version given an apt package version or wildcard.
+
+        A package from the gitlab-package resource is installed from the local
+        cache in place of downloading it, when its version is exactly the
+        version being installed.
+        """
+        target = self.get_package_target(version)
+        cached = self.get_cached_package(target) if target else None
+        if cached:
+            hookenv.log("Installing {} from the local package cache".format(cached))
+            apt_install(cached, fatal=True)
+        elif version:
             apt_install("{}={}".format(self.package_name, version), fatal=True)
         else:
             apt_install("{}".format(self.package_name), fatal=True)
+        self.stop_rails_query_server()
 
+    @timed_operation("upgrade")
     def upgrade_gitlab(self):
         """Check if a major version upgrade is being performed and install upgrades in the correct order."""
         hookenv.log("Processing pending package upgrades for GitLab")
@@ -521,107 +1604,541 @@ class GitlabHelper:
                 self.upgrade_package()
                 return True
 
-    def render_config(self):
-        """Render the configuration for GitLab omnibus."""
+    def get_database_context(self):
+        """Return the gitlab.rb database settings for whichever database is configured, or None."""
         if self.pgsql_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "postgresql",
-                    "db_host": self.kv.get("pgsql_host"),
-                    "db_port": self.kv.get("pgsql_port"),
-                    "db_database": self.kv.get("pgsql_db"),
-                    "db_user": self.kv.get("pgsql_user"),
-                    "db_password": self.kv.get("pgsql_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config.get("http_port"),
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
-            )
+            prefix, adapter = "pgsql", "postgresql"
         elif self.mysql_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "mysql2",
-                    "db_host": self.kv.get("mysql_host"),
-                    "db_port": self.kv.get("mysql_port"),
-                    "db_database": self.kv.get("mysql_db"),
-                    "db_user": self.kv.get("mysql_user"),
-                    "db_password": self.kv.get("mysql_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config["http_port"],
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
-            )
+            prefix, adapter = "mysql", "mysql2"
         elif self.legacy_db_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "mysql2",
-                    "db_host": self.kv.get("db_host"),
-                    "db_port": self.kv.get("db_port"),
-                    "db_database": self.kv.get("db_db"),
-                    "db_user": self.kv.get("db_user"),
-                    "db_password": self.kv.get("db_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config["http_port"],
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
-            )
+            prefix, adapter = "db", "mysql2"
         else:
+            return None
+        return {
+            "db_adapter": adapter,
+            "db_host": self.kv.get("{}_host".format(prefix)),
+            "db_port": self.kv.get("{}_port".format(prefix)),
+            "db_database": self.kv.get("{}_db".format(prefix)),
+            "db_user": self.kv.get("{}_user".format(prefix)),
+            "db_password": self.kv.get("{}_pass".format(prefix)),
+        }
+
+    def get_tuning_profile(self):
+        """Return the name of the configured tuning profile, choosing one by CPU cores and RAM for auto."""
+        profile = self.charm_config.get("tuning_profile")
+        if profile == "auto":
+            cores = os.cpu_count() or 1
+            ram_gb = host.get_total_ram() / 1024 ** 3
+            minimums = sorted(self.tuning_profile_minimums.items(), key=lambda item: item[1])
+            profile = [name for name, (cpus, ram) in minimums if cores >= cpus and ram_gb >= ram][-1]
+            hookenv.log("Using tuning profile {} for {} cores and {:.1f}GB RAM".format(profile, cores, ram_gb))
+        if profile and profile not in self.tuning_profiles:
+            hookenv.log("Unknown tuning profile {}, ignoring".format(profile), hookenv.ERROR)
+            return None
+        return profile or None
+
+    def get_tuning(self):
+        """Return the tuned omnibus settings as sorted (key, value) pairs.
+
+        Values come from the tuning profile, with any of the per-setting
+        options which are not 0 overriding them. Unless overridden, the
+        database pool is sized so every Puma thread and Sidekiq job can hold
+        a connection, and the Puma worker memory limit is sized from RAM.
+        gitaly-ruby workers are left out on GitLab 16.0 and later.
+        """
+        settings = dict(self.tuning_profiles.get(self.get_tuning_profile(), {}))
+        for option in self.tuning_settings:
+            if self.charm_config.get(option):
+                settings[option] = self.charm_config[option]
+        if self.uses_gitaly_configuration():
+            settings.pop("gitaly_ruby_workers", None)
+        threads = max(settings.get("puma_max_threads", 0), settings.get("sidekiq_concurrency", 0))
+        if threads and "db_pool" not in settings:
+            settings["db_pool"] = threads + 5
+        if "puma_per_worker_max_memory_mb" not in settings:
+            limit = self.get_puma_worker_memory_limit(settings)
+            if limit:
+                settings["puma_per_worker_max_memory_mb"] = limit
+        return sorted((self.tuning_settings[option], value) for option, value in settings.items())
+
+    def get_puma_worker_memory_limit(self, settings):
+        """Return the memory in MB each Puma worker may use before the worker killer restarts it, or None.
+
+        RAM left after the headroom for Sidekiq, Gitaly and the OS is shared
+        between the Puma workers and master, up to the highest of
+        puma_worker_memory_limits. None leaves GitLab's stock limit in place
+        when the share isn't above it, so workers never restart more often.
+        Without puma_memory_headroom_mb, 4GB is kept plus 300MB per gitaly-ruby
+        worker, for GitLab releases which still run gitaly-ruby.
+        """
+        cores = os.cpu_count() or 1
+        workers = settings.get("puma_workers") or max(2, cores)
+        ruby_workers = 0 if self.uses_gitaly_configuration() else settings.get("gitaly_ruby_workers") or 2
+        headroom = self.charm_config.get("puma_memory_headroom_mb") or 4096 + 300 * ruby_workers
+        ram_mb = host.get_total_ram() // (1024 * 1024)
+        limit = (ram_mb - headroom) // (workers + 1)
+        lowest, highest = self.puma_worker_memory_limits
+        if limit <= lowest:
+            return None
+        return min(limit, highest)
+
+    def get_sysctl_settings(self):
+        """Return the kernel settings for GitLab's connection backlogs, open files and inotify watches.
+
+        The listen backlog defaults to one nginx worker's connections, so a
+        burst can queue for the accept queue instead of being dropped. Values
+        are never lowered below those in effect before the charm first
+        changed them.
+        """
+        tuning = dict(self.get_tuning())
+        connections = tuning.get(self.tuning_settings["nginx_worker_connections"], 10240)
+        workers = tuning.get(self.tuning_settings["nginx_workers"], os.cpu_count() or 1)
+        backlog = self.charm_config.get("listen_backlog") or max(4096, min(connections, 65535))
+        settings = {
+            "net.core.somaxconn": backlog,
+            "net.ipv4.tcp_max_syn_backlog": backlog,
+            # every nginx connection may also hold an upstream connection
+            "fs.file-max": workers * connections * 2 + 65536,
+            "fs.inotify.max_user_watches": 524288,
+            "fs.inotify.max_user_instances": 512,
+        }
+        baseline = self.kv.get("sysctl_baseline")
+        if baseline is None:
+            baseline = {key: self.read_sysctl(key) for key in settings}
+            self.kv.set("sysctl_baseline", baseline)
+        return {key: max(value, baseline.get(key) or 0) for key, value in settings.items()}
+
+    def read_sysctl(self, key):
+        """Return the current value of an integer kernel setting, or None if it can't be read."""
+        try:
+            with open(os.path.join("/proc/sys", key.replace(".", "/")), "r") as setting:
+                return int(setting.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def configure_sysctl(self):
+        """Write and apply the sysctl drop-in when its settings change, without needing a reboot.
+
+        With manage_sysctl off, the drop-in is removed so its settings aren't
+        applied again at boot.
+        """
+        if not self.charm_config.get("manage_sysctl"):
+            if os.path.exists(self.sysctl_config):
+                hookenv.log("Removing {}, its settings apply until reboot".format(self.sysctl_config))
+                os.remove(self.sysctl_config)
+            self.kv.unset("sysctl_settings")
+            return
+        settings = self.get_sysctl_settings()
+        if settings == self.kv.get("sysctl_settings"):
+            return
+        hookenv.log("Applying sysctl settings {}".format(settings))
+        sysctl.create(settings, self.sysctl_config, ignore=True)
+        self.kv.set("sysctl_settings", settings)
+
+    def get_gitlab_version(self):
+        """Return the installed GitLab version as a (major, minor) tuple, or None if it isn't installed."""
+        version = self.get_dpkg_version()
+        if not version:
+            return None
+        version = semantic_version.Version(version)
+        return version.major, version.minor
+
+    def uses_gitaly_configuration(self):
+        """Return whether the installed GitLab sets Gitaly through gitaly['configuration'].
+
+        Omnibus 16.0 dropped the flat gitaly[] keys, and gitaly-ruby with
+        them. Unknown versions are treated as older releases.
+        """
+        version = self.get_gitlab_version()
+        return bool(version) and version >= (16, 0)
+
+    def get_components(self):
+        """Return whether each optional omnibus component is enabled, from its enable_ option.
+
+        KAS and Grafana are None when the installed GitLab doesn't support
+        setting them, as gitlab.rb must not mention them.
+        """
+        components = {
+            component: bool(self.charm_config.get("enable_{}".format(component)))
+            for component in self.component_services
+        }
+        version = self.get_gitlab_version()
+        if not version or version < (13, 7):
+            components["kas"] = None
+        # Grafana was removed from the omnibus package in 16.3
+        components["grafana"] = components["monitoring"] if version and version < (16, 3) else None
+        return components
+
+    def get_disabled_services(self):
+        """Return the runit services which should not be running."""
+        components = self.get_components()
+        services = set(self.disabled_services)
+        for component, component_services in self.component_services.items():
+            if not components.get(component):
+                services.update(component_services)
+        if not components["monitoring"] and self.kv.get("scrape_whitelist") is None:
+            services.add("gitlab-exporter")
+        return services
+
+    def stop_disabled_services(self):
+        """Stop any runit services of disabled components which reconfigure left running."""
+        services = self.get_disabled_services()
+        for service, state in sorted(self.get_service_status().items()):
+            if service in services and state == "run":
+                hookenv.log("Stopping disabled service {}".format(service))
+                self.gitlab_ctl("stop", service)
+
+    def get_repository_storages(self):
+        """Return the repository storage shards as sorted (name, path) pairs, starting with the default storage.
+
+        Each attached volume of the repositories storage is a shard named after
+        its Juju storage ID, e.g. repositories-1.
+        """
+        attached = self.kv.get("repository_storages", {})
+        return [("default", self.default_git_data_dir)] + sorted(
+            (storage_id.replace("/", "-"), path) for storage_id, path in attached.items()
+        )
+
+    def attach_repository_storage(self, storage_id):
+        """Record an attached repositories volume, so it's rendered as a repository storage shard."""
+        path = hookenv.storage_get("location", storage_id)
+        hookenv.log("Adding repository storage {} at {}".format(storage_id, path))
+        attached = self.kv.get("repository_storages", {})
+        attached[storage_id] = path
+        self.kv.set("repository_storages", attached)
+
+    def detach_repository_storage(self, storage_id):
+        """Forget a detaching repositories volume, removing its shard from GitLab."""
+        attached = self.kv.get("repository_storages", {})
+        if attached.pop(storage_id, None) is None:
+            return
+        hookenv.log(
+            "Removing repository storage {}, repositories left on it will be unavailable".format(storage_id),
+            hookenv.WARNING,
+        )
+        self.kv.set("repository_storages", attached)
+
+    def get_data_storages(self):
+        """Return the omnibus paths moved onto attached data volumes as sorted (key, path) pairs."""
+        attached = self.kv.get("data_storages", {})
+        return sorted((self.data_storage_paths[name], path) for name, path in attached.items())
+
+    def attach_data_storage(self, storage_id):
+        """Record an attached artifacts, lfs, uploads or backups volume, so GitLab stores that data on it."""
+        name = storage_id.split("/")[0]
+        path = hookenv.storage_get("location", storage_id)
+        hookenv.log("Moving {} to storage {} at {}".format(name, storage_id, path))
+        attached = self.kv.get("data_storages", {})
+        attached[name] = path
+        self.kv.set("data_storages", attached)
+
+    def detach_data_storage(self, storage_id):
+        """Forget a detaching data volume, returning GitLab to the default path for its data."""
+        name = storage_id.split("/")[0]
+        attached = self.kv.get("data_storages", {})
+        if attached.pop(name, None) is None:
+            return
+        hookenv.log(
+            "Removing {} storage {}, data left on it will be unavailable".format(name, storage_id),
+            hookenv.WARNING,
+        )
+        self.kv.set("data_storages", attached)
+
+    def get_repository_storage_weights(self):
+        """Return the weights used to place new repositories on each repository storage shard.
+
+        Unless set by repository_storage_weights, attached volumes take all new
+        repositories, and the default storage only takes them without volumes.
+        Raises ValueError for invalid weights or unknown shards.
+        """
+        names = [name for name, _ in self.get_repository_storages()]
+        weights = {name: self.repository_storage_weight for name in names}
+        if len(names) > 1:
+            weights["default"] = 0
+        try:
+            configured = yaml.safe_load(self.charm_config.get("repository_storage_weights") or "") or {}
+        except yaml.YAMLError as e:
+            raise ValueError("repository_storage_weights is not valid YAML: {}".format(e))
+        if not isinstance(configured, dict) or not all(
+            isinstance(weight, int) and 0 <= weight <= 100 for weight in configured.values()
+        ):
+            raise ValueError("repository_storage_weights must be a map of storage names to weights from 0 to 100")
+        unknown = sorted(str(name) for name in configured if name not in weights)
+        if unknown:
+            raise ValueError("repository_storage_weights has unknown storages: {}".format(", ".join(unknown)))
+        weights.update(configured)
+        if not any(weights.values()):
+            raise ValueError("repository_storage_weights leaves no storage for new repositories")
+        return weights
+
+    def get_housekeeping_window(self):
+        """Return Gitaly's daily maintenance settings for housekeeping_window, or None when it's unset.
+
+        Raises ValueError unless the window is two times in HH:MM-HH:MM form.
+        """
+        window = self.charm_config.get("housekeeping_window")
+        if not window:
+            return None
+        match = re.match(r"^([01]?\d|2[0-3]):([0-5]\d)-([01]?\d|2[0-3]):([0-5]\d)$", window.strip())
+        if not match:
+            raise ValueError("housekeeping_window must be HH:MM-HH:MM, e.g. 01:00-05:00")
+        start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+        # windows may span midnight
+        duration = (end_hour * 60 + end_minute - start_hour * 60 - start_minute) % (24 * 60)
+        if not duration:
+            raise ValueError("housekeeping_window must not be empty")
+        return {
+            "start_hour": start_hour,
+            "start_minute": start_minute,
+            "duration": "{}m".format(duration),
+            "storages": self.to_ruby([name for name, _ in self.get_repository_storages()]),
+        }
+
+    def get_application_settings(self):
+        """Return the application settings managed by the charm.
+
+        Repository storage weights are only managed once repositories volumes
+        are attached or weights are configured, so weights set in GitLab are
+        otherwise left alone. Housekeeping periods left at 0 are left to
+        GitLab's own settings.
+        """
+        settings = {}
+        if (
+            len(self.get_repository_storages()) > 1
+            or self.charm_config.get("repository_storage_weights")
+            # weights of the last detached volume must still be removed
+            or "repository_storages_weighted" in self.kv.get("application_settings", {})
+        ):
+            settings["repository_storages_weighted"] = self.get_repository_storage_weights()
+        for setting in self.housekeeping_settings:
+            period = self.charm_config.get(setting)
+            if period:
+                settings[setting] = period
+        return settings
+
+    def update_application_settings(self):
+        """Apply the managed application settings which changed since they were last applied.
+
+        Settings are applied directly to the database without reconfiguring
+        GitLab. The last applied settings are kept in the KV store, so Rails is
+        only booted when they change. Returns True if any settings were updated.
+        """
+        try:
+            settings = self.get_application_settings()
+        except ValueError as e:
+            # render_config has already blocked the unit
+            hookenv.log("Skipping application settings: {}".format(e), hookenv.ERROR)
+            return False
+        applied = self.kv.get("application_settings", {})
+        changed = {name: value for name, value in settings.items() if applied.get(name) != value}
+        if not changed:
+            return False
+        hookenv.log("Updating application settings {}".format(", ".join(sorted(changed))))
+        try:
+            self.gitlab_rails_run(
+                "ApplicationSetting.current_without_cache.update!({})".format(self.to_ruby(changed))
+            )
+        except subprocess.CalledProcessError as e:
+            hookenv.log("Updating application settings failed: {}".format(e), hookenv.ERROR)
+            return False
+        applied.update(changed)
+        self.kv.set("application_settings", applied)
+        return True
+
+    def run_housekeeping(self, projects):
+        """Schedule housekeeping for the projects with the given full paths, e.g. group/project.
+
+        All projects are handled by a single gitlab-rails runner. Returns the
+        paths of the scheduled projects, and the reasons any weren't.
+        """
+        templating.render(
+            "housekeeping.rb.j2",
+            self.housekeeping_script,
+            {"projects": self.to_ruby(projects)},
+            perms=0o644,
+        )
+        output = self.gitlab_rails_run(self.housekeeping_script)
+        statuses = json.loads(output.strip().splitlines()[-1])
+        scheduled = [project for project in projects if statuses.get(project) == "scheduled"]
+        failed = [
+            "{}: {}".format(project, statuses.get(project, "no result"))
+            for project in projects
+            if project not in scheduled
+        ]
+        hookenv.log("Scheduled housekeeping for {} of {} projects".format(len(scheduled), len(projects)))
+        results = {"scheduled": ", ".join(scheduled)}
+        if failed:
+            results["failed"] = "; ".join(failed)
+        return results
+
+    def get_rails_env(self):
+        """Return the Ruby GC and malloc environment for Puma and Sidekiq as a Ruby hash, or None.
+
+        Variables set by gitlab_rails['env'] in gitlab_rb_overrides are kept,
+        ruby_env takes precedence over them, and the explicit options over both.
+        Raises ValueError if ruby_env isn't a YAML map of environment variable names.
+        """
+        env = self.load_gitlab_rb_overrides().get(self.rails_env_key) or {}
+        if not isinstance(env, dict):
+            raise ValueError("gitlab_rb_overrides must set {} to a map".format(self.rails_env_key))
+        try:
+            ruby_env = yaml.safe_load(self.charm_config.get("ruby_env") or "") or {}
+        except yaml.YAMLError as e:
+            raise ValueError("ruby_env is not valid YAML: {}".format(e))
+        if not isinstance(ruby_env, dict) or not all(
+            re.match(r"^[A-Z_][A-Z0-9_]*$", str(name)) for name in ruby_env
+        ):
+            raise ValueError("ruby_env must be a map of environment variable names to values")
+        env.update(ruby_env)
+        options = {
+            "RUBY_GC_HEAP_INIT_SLOTS": self.charm_config.get("ruby_gc_heap_init_slots"),
+            "RUBY_GC_HEAP_GROWTH_FACTOR": self.charm_config.get("ruby_gc_heap_growth_factor"),
+            "MALLOC_ARENA_MAX": self.charm_config.get("malloc_arena_max"),
+            "MALLOC_CONF": self.charm_config.get("jemalloc_conf"),
+        }
+        env.update((name, value) for name, value in options.items() if value)
+        if not env:
+            return None
+        # environment values are strings
+        return self.to_ruby({name: str(value) for name, value in env.items()})
+
+    def get_config_context(self):
+        """Return the gitlab.rb template context shared by all database backends."""
+        return {
+            "redis_host": self.kv.get("redis_host"),
+            "redis_port": self.kv.get("redis_port"),
+            "http_port": self.charm_config.get("http_port"),
+            "ssh_host": self.get_sshhost(),
+            "ssh_port": self.get_sshport(),
+            "smtp_enabled": self.get_smtp_enabled(),
+            "smtp_server": self.charm_config.get("smtp_server"),
+            "smtp_port": self.charm_config.get("smtp_port"),
+            "smtp_user": self.charm_config.get("smtp_user"),
+            "smtp_password": self.charm_config.get("smtp_password"),
+            "smtp_domain": self.get_smtp_domain(),
+            "smtp_authentication": self.charm_config.get("smtp_authentication"),
+            "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
+            "email_from": self.charm_config.get("email_from"),
+            "email_display_name": self.charm_config.get("email_display_name"),
+            "email_reply_to": self.charm_config.get("email_reply_to"),
+            "url": self.get_external_uri(),
+            "metrics": self.get_metrics_context(),
+            "gitaly_configuration": self.uses_gitaly_configuration(),
+            "tuning": self.get_tuning(),
+            "components": {
+                component: None if enabled is None else str(enabled).lower()
+                for component, enabled in self.get_components().items()
+            },
+            "pages_external_url": self.charm_config.get("pages_external_url"),
+            "registry_external_url": self.charm_config.get("registry_external_url"),
+            "mattermost_external_url": self.charm_config.get("mattermost_external_url"),
+        }
+
+    def get_gitlab_rb_keys(self):
+        """Return the omnibus keys known to the gitlab.rb template, and those the charm always manages.
+
+        Known keys are those in the template's reference settings. Managed keys
+        are set unconditionally in the charm's block at the top of the file.
+        """
+        with open(os.path.join(hookenv.charm_dir(), "templates", "gitlab.rb.j2"), "r") as template:
+            managed, reference = template.read().split("Reference Configuration Settings", 1)
+        key = r"(\w+\['\w+'\])\s*="
+        known = set(re.findall(r"^#\s*" + key, reference, re.MULTILINE))
+        return known, set(re.findall(r"^" + key, managed, re.MULTILINE))
+
+    def to_ruby(self, value):
+        """Return a YAML value as a Ruby literal for gitlab.rb."""
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if value is None:
+            return "nil"
+        if isinstance(value, (int, float)):
+            return str(value)
+        if isinstance(value, list):
+            return "[{}]".format(", ".join(self.to_ruby(item) for item in value))
+        if isinstance(value, dict):
+            return "{{{}}}".format(
+                ", ".join(
+                    "{} => {}".format(self.to_ruby(str(key)), self.to_ruby(item))
+                    for key, item in sorted(value.items(), key=lambda pair: str(pair[0]))
+                )
+            )
+        # escape interpolation as well as quotes in the double quoted string
+        return json.dumps(str(value)).replace("#", "\\#")
+
+    def load_gitlab_rb_overrides(self):
+        """Return the gitlab_rb_overrides option as a map, raising ValueError unless it's a YAML map."""
+        try:
+            overrides = yaml.safe_load(self.charm_config.get("gitlab_rb_overrides") or "") or {}
+        except yaml.YAMLError as e:
+            raise ValueError("gitlab_rb_overrides is not valid YAML: {}".format(e))
+        if not isinstance(overrides, dict):
+            raise ValueError("gitlab_rb_overrides must be a map of gitlab.rb keys to values")
+        return overrides
+
+    def get_gitlab_rb_overrides(self):
+        """Return the gitlab_rb_overrides option as sorted (key, Ruby value) pairs.
+
+        Raises ValueError for invalid YAML, keys unknown to the gitlab.rb
+        template, and keys the charm manages itself. As the template's
+        reference settings predate newer GitLab releases, keys listed in
+        gitlab_rb_override_keys are accepted too. An override of
+        gitlab_rails['env'] is merged into the Ruby runtime environment by
+        get_rails_env instead.
+        """
+        overrides = self.load_gitlab_rb_overrides()
+        overrides.pop(self.rails_env_key, None)
+        known, managed = self.get_gitlab_rb_keys()
+        known.update((self.charm_config.get("gitlab_rb_override_keys") or "").replace(",", " ").split())
+        managed_keys = sorted(key for key in overrides if key in managed)
+        if managed_keys:
+            raise ValueError("gitlab_rb_overrides sets keys managed by the charm: {}".format(", ".join(managed_keys)))
+        unknown = sorted(str(key) for key in overrides if key not in known)
+        if unknown:
+            raise ValueError("gitlab_rb_overrides has unknown keys: {}".format(", ".join(unknown)))
+        return sorted((key, self.to_ruby(value)) for key, value in overrides.items())
+
+    def get_config_error(self):
+        """Return why the charm's gitlab.rb and application settings options are invalid, or None if they're valid."""
+        try:
+            self.get_gitlab_rb_overrides()
+            self.get_rails_env()
+            self.get_housekeeping_window()
+            self.get_application_settings()
+        except ValueError as e:
+            return str(e)
+        return None
+
+    def render_config(self):
+        """Render the configuration for GitLab omnibus."""
+        db_context = self.get_database_context()
+        if db_context is None:
             hookenv.status_set(
                 "blocked",
                 "DB configuration is missing. Verify database relations to continue.",
             )
             hookenv.log("Skipping configuration due to missing DB config")
             return False
+        try:
+            overrides = self.get_gitlab_rb_overrides()
+            rails_env = self.get_rails_env()
+            housekeeping_window = self.get_housekeeping_window()
+            self.get_application_settings()
+        except ValueError as e:
+            hookenv.status_set("blocked", str(e))
+            hookenv.log("Skipping configuration: {}".format(e), hookenv.ERROR)
+            return False
+        context = self.get_config_context()
+        context.update(db_context)
+        context["overrides"] = overrides
+        context["rails_env"] = rails_env
+        context["repository_storages"] = self.get_repository_storages()
+        context["data_storages"] = self.get_data_storages()
+        context["housekeeping_window"] = housekeeping_window
+        templating.render("gitlab.rb.j2", self.gitlab_config, context)
         if any_file_changed([self.gitlab_config]):
             if self.gitlab_reconfigure_run():
+                self.stop_disabled_services()
                 hookenv.status_set(
                     "active",
                     "GitLab configured."
@@ -633,6 +2150,490 @@ class GitlabHelper:
         )
         return False
 
+    def get_metrics_context(self):
+        """Return the metrics exporter settings for gitlab.rb, or None when nothing scrapes GitLab.
+
+        Exporters listen on the scrape binding address, and the scraping
+        units are added to the monitoring whitelist for the Rails endpoint.
+        """
+        whitelist = self.kv.get("scrape_whitelist")
+        if whitelist is None:
+            return None
+        return {
+            "address": self.get_metrics_address(),
+            "ports": self.metrics_ports,
+            "whitelist": self.monitoring_whitelist + whitelist,
+        }
+
+    def get_metrics_address(self):
+        """Return the address GitLab's exporters listen on for the scrape relation."""
+        return self.get_binding_address("scrape") or hookenv.unit_private_ip()
+
+    def get_scrape_jobs(self):
+        """Return the Prometheus scrape job for each GitLab metrics endpoint, keyed by job name."""
+        address = self.get_metrics_address()
+        jobs = {
+            "gitlab-rails": {
+                "metrics_path": "/-/metrics",
+                "static_configs": [
+                    {"targets": ["{}:{}".format(address, self.charm_config["http_port"])]}
+                ],
+            }
+        }
+        for service, port in self.metrics_ports.items():
+            jobs[service] = {
+                "metrics_path": "/metrics",
+                "static_configs": [{"targets": ["{}:{}".format(address, port)]}],
+            }
+        return jobs
+
+    def get_scrape_whitelist(self, endpoint):
+        """Return the sorted networks of every unit scraping GitLab over the endpoint."""
+        networks = set()
+        for relation in endpoint.relations:
+            for unit in relation.joined_units:
+                subnets = unit.received_raw.get("egress-subnets") or ""
+                address = unit.received_raw.get("ingress-address") or unit.received_raw.get(
+                    "private-address"
+                )
+                networks.update(subnet.strip() for subnet in subnets.split(",") if subnet.strip())
+                if not subnets and address:
+                    networks.add(address)
+        return sorted(networks)
+
+    def configure_scrape(self, endpoint):
+        """Whitelist the scraping units, reconfiguring GitLab if they changed, and publish the scrape jobs.
+
+        Returns True if GitLab's configuration changed.
+        """
+        whitelist = self.get_scrape_whitelist(endpoint)
+        changed = whitelist != self.kv.get("scrape_whitelist")
+        if changed:
+            self.kv.set("scrape_whitelist", whitelist)
+            self.render_config()
+        for job_name, job_data in sorted(self.get_scrape_jobs().items()):
+            endpoint.register_job(job_name=job_name, job_data=job_data)
+        return changed
+
+    def remove_scrape(self):
+        """Disable GitLab's exporters once nothing scrapes them."""
+        if self.kv.get("scrape_whitelist") is not None:
+            self.kv.unset("scrape_whitelist")
+            self.render_config()
+
+    def http_probe(self, path):
+        """Request a local GitLab endpoint, returning the HTTP status, JSON body and latency in ms.
+
+        The status is None when GitLab could not be reached within health_timeout.
+        """
+        url = "http://127.0.0.1:{}{}".format(self.charm_config["http_port"], path)
+        started = time.time()
+        try:
+            response = urlopen(url, timeout=self.health_timeout)
+            code, body = response.getcode(), response.read()
+        except HTTPError as e:
+            code, body = e.code, e.read()
+        except (URLError, OSError) as e:
+            hookenv.log("Probe of {} failed: {}".format(url, e), hookenv.WARNING)
+            code, body = None, b""
+        latency = int((time.time() - started) * 1000)
+        try:
+            body = json.loads(body.decode("utf-8"))
+        except ValueError:
+            body = None
+        return code, body, latency
+
+    def get_service_status(self):
+        """Return the runit state of each omnibus service, e.g. {"puma": "run", "sidekiq": "down"}."""
+        try:
+            output = subprocess.check_output(
+                ["/usr/bin/gitlab-ctl", "status"],
+                stderr=subprocess.STDOUT,
+                timeout=self.health_timeout,
+            )
+        except subprocess.CalledProcessError as e:
+            # gitlab-ctl status exits non-zero when any service is down
+            output = e.output
+        except subprocess.TimeoutExpired:
+            hookenv.log("gitlab-ctl status timed out", hookenv.WARNING)
+            return {}
+        services = {}
+        for line in output.decode("utf-8").splitlines():
+            fields = line.split(":")
+            if len(fields) > 2:
+                services[fields[1].strip()] = fields[0].strip()
+        return services
+
+    def check_health(self):
+        """Probe GitLab's liveness and readiness endpoints and service states.
+
+        Returns the components which are down, those which are slow along with
+        their latency, and the readiness latency. Results are cached in the KV
+        store for health_cache_ttl seconds.
+        """
+        cached = self.kv.get("health_check")
+        if cached and time.time() - cached["checked"] < self.health_cache_ttl:
+            return cached
+        down, slow = set(), {}
+        code, _, latency = self.http_probe("/-/liveness")
+        if code != 200:
+            down.add("Puma")
+        elif latency > self.health_slow_ms:
+            slow["Puma"] = latency
+        code, body, readiness_latency = self.http_probe("/-/readiness?all=1")
+        for check, results in (body or {}).items():
+            if isinstance(results, list) and any(
+                result.get("status") != "ok" for result in results
+            ):
+                down.add(self.component_names.get(check, check))
+        if code == 200 and readiness_latency > self.health_slow_ms and not slow:
+            slow["Readiness"] = readiness_latency
+        disabled = self.get_disabled_services()
+        for service, state in self.get_service_status().items():
+            if state != "run" and service not in disabled:
+                down.add(self.component_names.get(service, service))
+        health = {
+            "checked": time.time(),
+            "down": sorted(down),
+            "slow": slow,
+            "latency": readiness_latency if code == 200 else None,
+            "backlog": [] if "Sidekiq" in down else self.check_sidekiq_queues(),
+        }
+        self.kv.set("health_check", health)
+        return health
+
+    def read_redis_reply(self, reader):
+        """Read a RESP reply from Redis, raising RedisError for error replies."""
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise OSError("Redis closed the connection")
+        kind, data = line[:1], line[1:-2].decode("utf-8", "replace")
+        if kind == b"-":
+            raise RedisError(data)
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            length = int(data)
+            return None if length < 0 else reader.read(length + 2)[:-2].decode("utf-8", "replace")
+        if kind == b"*":
+            length = int(data)
+            return None if length < 0 else [self.read_redis_reply(reader) for _ in range(length)]
+        return data
+
+    @contextlib.contextmanager
+    def redis_connection(self, timeout, host, port, password=None):
+        """Connect to Redis, yielding a function which runs a command and returns its reply."""
+        with socket.create_connection((host, int(port)), timeout=timeout) as connection:
+            reader = connection.makefile("rb")
+
+            def command(*args):
+                request = [b"*%d\r\n" % len(args)]
+                for arg in args:
+                    arg = str(arg).encode("utf-8")
+                    request.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+                connection.sendall(b"".join(request))
+                return self.read_redis_reply(reader)
+
+            if password:
+                command("AUTH", password)
+            try:
+                yield command
+            finally:
+                reader.close()
+
+    def get_sidekiq_queues(self, command):
+        """Return the size and latency in seconds of each Sidekiq queue, read from Redis.
+
+        The latency is the time the oldest job in the queue has been waiting.
+        """
+        queues = {}
+        now = time.time()
+        for namespace in self.sidekiq_namespaces:
+            for name in command("SMEMBERS", "{}queues".format(namespace)) or []:
+                key = "{}queue:{}".format(namespace, name)
+                size = command("LLEN", key)
+                latency = 0
+                if size:
+                    job = json.loads(command("LINDEX", key, -1) or "{}")
+                    enqueued_at = float(job.get("enqueued_at") or now)
+                    # Sidekiq 8 records milliseconds
+                    if enqueued_at > 1e11:
+                        enqueued_at /= 1000
+                    latency = max(now - enqueued_at, 0)
+                queues[name] = {"size": size, "latency": latency}
+        return queues
+
+    def check_sidekiq_queues(self):
+        """Return the Sidekiq queues over the configured size or latency thresholds.
+
+        Each queue is returned as (name, size, latency in seconds), most
+        delayed first. Queues are read straight from Redis, which is cheap
+        enough for every update-status.
+        """
+        size_threshold = self.charm_config.get("sidekiq_queue_size_threshold")
+        latency_threshold = self.charm_config.get("sidekiq_queue_latency_threshold")
+        if not (size_threshold or latency_threshold) or not self.redis_configured():
+            return []
+        try:
+            with self.redis_connection(
+                self.health_timeout,
+                self.kv.get("redis_host"),
+                self.kv.get("redis_port"),
+                self.kv.get("redis_pass"),
+            ) as command:
+                queues = self.get_sidekiq_queues(command)
+        except (OSError, ValueError, RedisError) as e:
+            hookenv.log("Unable to check Sidekiq queues: {}".format(e), hookenv.WARNING)
+            return []
+        backlog = []
+        for name, queue in queues.items():
+            size, latency = queue["size"], int(queue["latency"])
+            if (size_threshold and size >= size_threshold) or (
+                latency_threshold and latency >= latency_threshold
+            ):
+                backlog.append((name, size, latency))
+        return sorted(backlog, key=lambda queue: (-queue[2], -queue[1], queue[0]))
+
+    def get_health_status(self, healthy_message):
+        """Return the workload state and message describing GitLab's health.
+
+        Components which are down block the unit, slow components are named
+        in an active status along with their latency.
+        """
+        health = self.check_health()
+        problems = ["{} down".format(component) for component in health["down"]]
+        problems.extend(
+            "{} slow ({}ms)".format(component, latency)
+            for component, latency in sorted(health["slow"].items())
+        )
+        if health.get("backlog"):
+            queues = [
+                "{} ({} jobs, {}s)".format(name, size, latency)
+                for name, size, latency in health["backlog"][: self.backlog_queues_shown]
+            ]
+            if len(health["backlog"]) > self.backlog_queues_shown:
+                queues.append("{} more".format(len(health["backlog"]) - self.backlog_queues_shown))
+            problems.append("Sidekiq backlog {}".format(", ".join(queues)))
+        if health["down"]:
+            return "blocked", "GitLab degraded: {}".format(", ".join(problems))
+        if problems:
+            return "active", "GitLab slow: {}".format(", ".join(problems))
+        if health["latency"] is not None:
+            return "active", "{} (ready in {}ms)".format(
+                healthy_message, health["latency"]
+            )
+        return "active", healthy_message
+
+    def fetch_metrics(self, url, timeout):
+        """Fetch a Prometheus metrics endpoint, returning the samples as (name, labels, value) and the raw text."""
+        text = urlopen(url, timeout=timeout).read().decode("utf-8")
+        samples = []
+        for line in text.splitlines():
+            match = re.match(r"^([a-zA-Z_:][\w:]*)(\{[^}]*\})?\s+(\S+)", line)
+            if match:
+                samples.append((match.group(1), match.group(2) or "", float(match.group(3))))
+        return samples, text
+
+    def diagnose_puma(self, timeout):
+        """Return the RSS of each Puma worker and the busy threads reported by the Rails metrics."""
+        ps = subprocess.check_output(["ps", "-eo", "pid=,rss=,args="], timeout=timeout).decode("utf-8")
+        workers = {}
+        for line in ps.splitlines():
+            pid, rss, args = line.split(None, 2)
+            if "puma: cluster worker" in args:
+                workers[pid] = {"rss-mb": round(int(rss) / 1024, 1)}
+        samples, text = self.fetch_metrics(
+            "http://127.0.0.1:{}/-/metrics".format(self.charm_config["http_port"]), timeout
+        )
+        values = {}
+        for name, _, value in samples:
+            values[name] = values.get(name, 0) + value
+        busy = values.get("puma_max_threads", 0) - values.get("puma_pool_capacity", 0)
+        return (
+            {
+                "workers": len(workers),
+                "rss-mb": round(sum(worker["rss-mb"] for worker in workers.values()), 1),
+                "max-worker-rss-mb": max([worker["rss-mb"] for worker in workers.values()] or [0]),
+                "busy-threads": int(busy),
+                "max-threads": int(values.get("puma_max_threads", 0)),
+            },
+            ps + "\n" + text,
+        )
+
+    def diagnose_sidekiq(self, timeout, host, port, password):
+        """Return Sidekiq's processes and busy, enqueued, scheduled, retrying and dead jobs, read from Redis."""
+        stats = {"processes": 0, "busy": 0, "enqueued": 0, "scheduled": 0, "retries": 0, "dead": 0}
+        with self.redis_connection(timeout, host, port, password) as command:
+            queues = self.get_sidekiq_queues(command)
+            for namespace in self.sidekiq_namespaces:
+                processes = command("SMEMBERS", "{}processes".format(namespace)) or []
+                stats["processes"] += len(processes)
+                stats["busy"] += sum(
+                    int(command("HGET", "{}{}".format(namespace, process), "busy") or 0) for process in processes
+                )
+                stats["scheduled"] += command("ZCARD", "{}schedule".format(namespace))
+                stats["retries"] += command("ZCARD", "{}retry".format(namespace))
+                stats["dead"] += command("ZCARD", "{}dead".format(namespace))
+        stats["enqueued"] = sum(queue["size"] for queue in queues.values())
+        return stats, json.dumps({"stats": stats, "queues": queues}, indent=2, sort_keys=True)
+
+    def diagnose_gitaly(self, timeout, address):
+        """Return Gitaly's in-flight RPCs, in total and by gRPC method."""
+        samples, text = self.fetch_metrics("http://{}/metrics".format(address), timeout)
+        in_flight = {}
+        for name, labels, value in samples:
+            method = re.search(r'grpc_method="([^"]*)"', labels)
+            if method and name in ("grpc_server_started_total", "grpc_server_handled_total"):
+                sign = 1 if name == "grpc_server_started_total" else -1
+                in_flight[method.group(1)] = in_flight.get(method.group(1), 0) + sign * value
+        busy = sorted(
+            ((int(count), method) for method, count in in_flight.items() if count > 0), reverse=True
+        )
+        summary = "\n".join("{}\t{}".format(method, count) for count, method in busy)
+        return (
+            {"in-flight": sum(count for count, _ in busy), "busiest-method": busy[0][1] if busy else ""},
+            summary + "\n\n" + text,
+        )
+
+    def diagnose_postgresql(self, timeout, client):
+        """Return the PostgreSQL connections in use, by state, against max_connections."""
+        rows = self.run_query(
+            client,
+            "SELECT COALESCE(state, 'unknown'), COUNT(*) FROM pg_stat_activity GROUP BY 1",
+            timeout=timeout,
+        )
+        # action result keys may only hold lowercase letters, digits and hyphens
+        states = {re.sub(r"[^a-z0-9]+", "-", state.lower()).strip("-"): int(count) for state, count in rows}
+        max_connections = int(self.run_query(client, "SHOW max_connections", timeout=timeout)[0][0])
+        used = sum(states.values())
+        return (
+            {
+                "connections": used,
+                "max-connections": max_connections,
+                "usage-percent": round(100.0 * used / max_connections, 1),
+                "states": states,
+            },
+            "\n".join("{}\t{}".format(state, count) for state, count in sorted(states.items())),
+        )
+
+    def diagnose_redis(self, timeout, host, port, password, pings=5):
+        """Return the round trip latency of PING commands sent to Redis, in ms."""
+        latencies = []
+        with self.redis_connection(timeout, host, port, password) as command:
+            for _ in range(pings):
+                started = time.time()
+                reply = command("PING")
+                latencies.append((time.time() - started) * 1000)
+        result = {
+            "min-ms": round(min(latencies), 2),
+            "avg-ms": round(sum(latencies) / len(latencies), 2),
+            "max-ms": round(max(latencies), 2),
+        }
+        return result, reply
+
+    def diagnose_host(self, timeout, interval=1):
+        """Return the load averages and the CPU time spent waiting on disk I/O over an interval."""
+
+        def cpu_times():
+            with open("/proc/stat", "r") as stat:
+                return [int(field) for field in stat.readline().split()[1:]]
+
+        before = cpu_times()
+        time.sleep(min(interval, timeout))
+        after = cpu_times()
+        deltas = [end - start for start, end in zip(before, after)]
+        load = os.getloadavg()
+        with open("/proc/loadavg", "r") as loadavg:
+            raw = loadavg.read()
+        return (
+            {
+                "load-1": load[0],
+                "load-5": load[1],
+                "load-15": load[2],
+                "cpus": os.cpu_count(),
+                # the fifth field of the cpu line is iowait
+                "iowait-percent": round(100.0 * deltas[4] / (sum(deltas) or 1), 1),
+            },
+            raw,
+        )
+
+    def get_diagnostics(self):
+        """Return the diagnostics run by the diagnose action, as functions taking the timeout.
+
+        Settings are read here, as the KV store can't be used from the worker threads.
+        """
+        metrics = self.get_metrics_context()
+        gitaly = "{}:{}".format(metrics["address"] if metrics else "localhost", self.metrics_ports["gitaly"])
+        diagnostics = {
+            "puma": self.diagnose_puma,
+            "gitaly": functools.partial(self.diagnose_gitaly, address=gitaly),
+            "host": self.diagnose_host,
+        }
+        if self.pgsql_configured():
+            diagnostics["postgresql"] = functools.partial(
+                self.diagnose_postgresql, client=self.pgsql_client()
+            )
+        if self.redis_configured():
+            redis = {
+                "host": self.kv.get("redis_host"),
+                "port": self.kv.get("redis_port"),
+                "password": self.kv.get("redis_pass"),
+            }
+            diagnostics["sidekiq"] = functools.partial(self.diagnose_sidekiq, **redis)
+            diagnostics["redis"] = functools.partial(self.diagnose_redis, **redis)
+        return diagnostics
+
+    def diagnose(self, timeout=30):
+        """Capture a point-in-time performance profile of GitLab.
+
+        The diagnostics run concurrently in daemon threads, which are
+        abandoned after timeout seconds without holding up the action's exit.
+        Returns the results of each diagnostic, or its error, along with the
+        path of a tarball holding the results and raw output.
+        """
+        outcomes = {}
+
+        def run(name, diagnostic):
+            try:
+                outcomes[name] = diagnostic(timeout)
+            except Exception as e:
+                outcomes[name] = e
+
+        threads = []
+        for name, diagnostic in self.get_diagnostics().items():
+            thread = threading.Thread(target=run, args=(name, diagnostic), daemon=True)
+            thread.start()
+            threads.append((name, thread))
+        deadline = time.time() + timeout
+        for _, thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        results, raw = {}, {}
+        for name, _ in threads:
+            outcome = outcomes.get(name)
+            if outcome is None:
+                results[name] = {"error": "timed out after {}s".format(timeout)}
+            elif isinstance(outcome, Exception):
+                results[name] = {"error": str(outcome)}
+            else:
+                results[name], raw[name] = outcome
+        return {"results": results, "tarball": self.write_diagnostics(results, raw)}
+
+    def write_diagnostics(self, results, raw):
+        """Write the diagnostic results and raw output to a tarball, returning its path."""
+        host.mkdir(self.diagnostics_dir, perms=0o700)
+        name = "diagnose-{}".format(time.strftime("%Y%m%d-%H%M%S"))
+        path = os.path.join(self.diagnostics_dir, "{}.tar.gz".format(name))
+        files = {"results.json": json.dumps(results, indent=2, sort_keys=True)}
+        files.update(("{}.txt".format(diagnostic), output) for diagnostic, output in raw.items())
+        with tarfile.open(path, "w:gz") as tarball:
+            for filename, content in sorted(files.items()):
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo("{}/{}".format(name, filename))
+                info.size = len(data)
+                info.mtime = time.time()
+                tarball.addfile(info, io.BytesIO(data))
+        return path
+
     def open_ports(self):
         """Open ports based on configuration."""
         ports = ["80", str(self.charm_config["ssh_port"])]
@@ -658,23 +2659,110 @@ class GitlabHelper:
 
         Templates the configuration of the GitLab omnibus installer and
         runs the configuration routine to configure and start related services
-        based on charm configuration and relation data.
+        based on charm configuration and relation data. Returns False, leaving
+        the unit blocked and GitLab on its last configuration, when options
+        are invalid.
         """
+        error = self.get_config_error()
+        if error:
+            hookenv.status_set("blocked", error)
+            hookenv.log("Skipping configuration: {}".format(error), hookenv.ERROR)
+            return False
         self.install_pgclient()
+        self.configure_sysctl()
 
         if self.render_config():
             self.open_ports()
         else:
             self.close_ports()
+        self.update_application_settings()
 
         # check for upgrades
         self.upgrade_gitlab()
 
         return True
 
+    @timed_operation("backup")
     def backup(self):
         """Run Gitlab backup and backup from layer-backup."""
         cmd = ["sudo", "gitlab-backup", "create", "STRATEGY=copy"]
         subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         bh = BackupHelper()
         bh.backup()
+
+    def get_backup_env(self, concurrency=None, storage_concurrency=None):
+        """Return the environment for gitlab-backup with repository concurrency applied."""
+        env = os.environ.copy()
+        if concurrency:
+            env["GITLAB_BACKUP_MAX_CONCURRENCY"] = str(concurrency)
+        if storage_concurrency:
+            env["GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY"] = str(storage_concurrency)
+        return env
+
+    def verify_integrity(self):
+        """Run the GitLab integrity checks, returning True if they all pass."""
+        checks = [
+            ["/usr/bin/gitlab-rake", "gitlab:check", "SANITIZE=true"],
+            ["/usr/bin/gitlab-rake", "gitlab:doctor:secrets"],
+        ]
+        for check in checks:
+            try:
+                subprocess.check_output(check, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                hookenv.log(
+                    "Integrity check {} failed: {}".format(" ".join(check), e.output),
+                    hookenv.ERROR,
+                )
+                return False
+        return True
+
+    def restore(
+        self,
+        backup_id=None,
+        concurrency=None,
+        storage_concurrency=None,
+        skip=None,
+        verify=True,
+    ):
+        """Restore a GitLab backup from the GitLab backup directory.
+
+        Only the services writing to the database are stopped while the backup
+        is restored, and gitlab-ctl reconfigure is run once afterwards. Returns
+        the duration of each phase along with the reconfigure and integrity
+        check outcomes.
+        """
+        timings = {}
+        cmd = ["/usr/bin/gitlab-backup", "restore", "force=yes"]
+        if backup_id:
+            cmd.append("BACKUP={}".format(backup_id))
+        if skip:
+            cmd.append("SKIP={}".format(skip))
+
+        hookenv.status_set("maintenance", "Restoring GitLab backup")
+        with self.timed_phase(timings, "stop"):
+            for service in self.restore_services:
+                self.gitlab_ctl("stop", service)
+        try:
+            with self.timed_phase(timings, "restore"):
+                hookenv.log("Restoring GitLab backup: {}".format(" ".join(cmd)))
+                subprocess.check_output(
+                    cmd,
+                    stderr=subprocess.STDOUT,
+                    env=self.get_backup_env(concurrency, storage_concurrency),
+                )
+            # the restored database has its own registration token
+            self.invalidate_runner_token()
+            with self.timed_phase(timings, "reconfigure"):
+                reconfigured = self.gitlab_reconfigure_run()
+        finally:
+            with self.timed_phase(timings, "start"):
+                for service in self.restore_services:
+                    self.gitlab_ctl("start", service)
+
+        results = {"timings": timings, "reconfigured": reconfigured}
+        if verify:
+            with self.timed_phase(timings, "verify"):
+                results["verified"] = self.verify_integrity()
+        timings["total"] = round(sum(timings.values()), 3)
+        hookenv.log("GitLab restore completed: {}".format(results))
+        return results
@@ -1,15 +1,15 @@
 """Provides the main reactive layer for the GitLab charm."""
 
-import socket
-import subprocess
+import os
 
 from charmhelpers.core import hookenv
 from charms.reactive import (clear_flag, endpoint_from_flag,
-                             endpoint_from_name, is_flag_set, set_flag, when,
-                             when_all, when_any, when_none, when_not)
+                             endpoint_from_name, hook, is_flag_set, set_flag,
+                             when, when_all, when_any, when_none, when_not)
 from libgitlab import GitlabHelper
 
 gitlab = GitlabHelper()
+gitlab.watch_hook()
 
 HEALTHY = "GitLab installed and configured"
 
@@ -115,7 +115,7 @@ def enable_application():
 @when_all("gitlab.installed", "endpoint.redis.available")
 @when_any("db.available", "pgsql.database.available")
 @when_any(
-    "config.changed", "db.changed", "pgsql.database.changed", "endpoint.redis.changed"
+    "config.changed", "db.changed", "pgsql.database.changed", "endpoint.redis.changed", "gitlab.storage.changed"
 )
 def configure_gitlab(reverseproxy, *args):
     """Upgrade and reconfigure GitLab on configuration changes.
@@ -123,10 +123,15 @@ def configure_gitlab(reverseproxy, *args):
     Templates the GitLab Omnibus configuration file, rerunning the OmniBus
     installer to handle actual configuration.
     """
+    # Juju runs config-changed when the unit's addresses change
+    if is_flag_set("config.changed"):
+        gitlab.invalidate_network_identity()
+
     # These interfaces don't clear their changed status
     clear_flag("db.changed")
     clear_flag("pgsql.database.changed")
     clear_flag("endpoint.redis.changed")
+    clear_flag("gitlab.storage.changed")
 
     hookenv.status_set("maintenance", "Configuring GitLab")
     hookenv.log(
@@ -191,6 +196,44 @@ def configure_gitlab(reverseproxy, *args):
         hookenv.log("DB and/or Redis unconfigured, skipping install.")
 
 
+@hook("repositories-storage-attached")
+def attach_repository_storage():
+    """Add an attached repositories volume as a repository storage shard."""
+    gitlab.attach_repository_storage(os.environ["JUJU_STORAGE_ID"])
+    set_flag("gitlab.storage.changed")
+
+
+@hook("repositories-storage-detaching")
+def detach_repository_storage():
+    """Remove a detaching repositories volume's shard before it's unmounted."""
+    gitlab.detach_repository_storage(os.environ["JUJU_STORAGE_ID"])
+    set_flag("gitlab.storage.changed")
+
+
+@hook(
+    "artifacts-storage-attached",
+    "lfs-storage-attached",
+    "uploads-storage-attached",
+    "backups-storage-attached",
+)
+def attach_data_storage():
+    """Move the data class of an attached volume onto it."""
+    gitlab.attach_data_storage(os.environ["JUJU_STORAGE_ID"])
+    set_flag("gitlab.storage.changed")
+
+
+@hook(
+    "artifacts-storage-detaching",
+    "lfs-storage-detaching",
+    "uploads-storage-detaching",
+    "backups-storage-detaching",
+)
+def detach_data_storage():
+    """Return the data class of a detaching volume to its default path before it's unmounted."""
+    gitlab.detach_data_storage(os.environ["JUJU_STORAGE_ID"])
+    set_flag("gitlab.storage.changed")
+
+
 @when("reverseproxy.ready")
 @when_not("reverseproxy.configured")
 def configure_proxy():
@@ -205,44 +248,63 @@ def configure_proxy():
     set_flag("reverseproxy.configured")
 
 
-def get_runner_token():
-    """Get the runner token for registering a runner."""
-    cmd = [
-        "/usr/bin/gitlab-rails",
-        "runner",
-        "-e",
-        "production",
-        "STDOUT.write Gitlab::CurrentSettings.current_application_settings.runners_registration_token",
-    ]
-    token = subprocess.check_output(cmd)
-    return token.decode("utf-8")
-
-
 @when_all("endpoint.runner.joined", "gitlab.configured")
-@when_not("runner.published")
 def publish_runner_config():
-    """Publish the configuration for a runner to register."""
+    """Publish the configuration to every runner relation which has not yet received it."""
     endpoint = endpoint_from_flag("endpoint.runner.joined")
-    if gitlab.charm_config["runners_bypass_proxy"]:
-        server_uri = "http://{}".format(socket.getfqdn())
-    else:
-        server_uri = gitlab.get_external_uri()
-    server_token = get_runner_token()
-    hookenv.log(
-        "Publishing runner config uri/token: {}/{}".format(server_uri, server_token),
-        "DEBUG",
-    )
-    endpoint.publish(server_uri, server_token)
-    set_flag("runner.published")
+    published = gitlab.publish_runner_config(endpoint)
+    if published:
+        hookenv.log("Published runner config to {}".format(", ".join(published)))
+
+
+@when_all("endpoint.runner.changed", "gitlab.configured")
+def check_runner_token():
+    """Republish the runner config when the cached token no longer matches GitLab's."""
+    if gitlab.check_runner_token():
+        gitlab.publish_runner_config(endpoint_from_name("runner"))
+    clear_flag("endpoint.runner.changed")
 
 
 @when("endpoint.runner.departed")
 def handle_runner_departed():
     """Handle relations departed."""
-    clear_flag("runner.published")
+    endpoint = endpoint_from_name("runner")
+    gitlab.forget_departed_runners(endpoint)
+    clear_flag("endpoint.runner.departed")
+
+
+@when_all("endpoint.scrape.joined", "gitlab.configured")
+@when_any("endpoint.scrape.changed", "endpoint.scrape.departed", "config.changed")
+def configure_scrape():
+    """Enable GitLab's exporters for the scraping units and publish the scrape jobs."""
+    endpoint = endpoint_from_name("scrape")
+    if gitlab.configure_scrape(endpoint):
+        hookenv.log("Reconfigured GitLab metrics for the scrape relation")
+    clear_flag("endpoint.scrape.changed")
+    clear_flag("endpoint.scrape.departed")
+
+
+@when("endpoint.scrape.departed")
+@when_not("endpoint.scrape.joined")
+def remove_scrape():
+    """Disable GitLab's exporters once the last scrape relation has gone."""
+    hookenv.status_set("maintenance", "Removing scrape relation")
+    gitlab.remove_scrape()
+    clear_flag("endpoint.scrape.departed")
 
 
 @when_all("gitlab.installed", "endpoint.redis.available", "pgsql.database.available")
 def update_status_healthy():
-    """Update status if all flags are set to indicate good charm health."""
-    hookenv.status_set("active", HEALTHY)
+    """Update status from GitLab's health checks if all flags are set to indicate good charm health.
+
+    The checks only run in update-status, so they don't slow down other hooks
+    or report services still restarting after a reconfigure. Invalid options
+    keep the unit blocked.
+    """
+    error = gitlab.get_config_error()
+    if error:
+        hookenv.status_set("blocked", error)
+    elif is_flag_set("gitlab.configured") and hookenv.hook_name() == "update-status":
+        hookenv.status_set(*gitlab.get_health_status(HEALTHY))
+    else:
+        hookenv.status_set("active", HEALTHY)
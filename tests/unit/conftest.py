@@ -83,6 +83,36 @@ def mock_opened_ports(monkeypatch):
     return mocked_opened_ports
 
 
+@pytest.fixture
+def mock_action_get(monkeypatch):
+    """Mock action parameters, tests set values on the returned dict."""
+    params = {}
+
+    def mock_get(key=None):
+        if key is None:
+            return params
+        return params.get(key)
+
+    monkeypatch.setattr("libgitlab.hookenv.action_get", mock_get)
+    return params
+
+
+@pytest.fixture
+def mock_action_set(monkeypatch):
+    """Mock setting action results."""
+    mocked_action_set = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.action_set", mocked_action_set)
+    return mocked_action_set
+
+
+@pytest.fixture
+def mock_action_fail(monkeypatch):
+    """Mock failing an action."""
+    mocked_action_fail = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.action_fail", mocked_action_fail)
+    return mocked_action_fail
+
+
 @pytest.fixture
 def mock_get_installed_version(monkeypatch):
     """Mock the installed version."""
@@ -155,6 +185,21 @@ def mock_gitlab_socket(monkeypatch):
     return mock_socket
 
 
+@pytest.fixture
+def mock_unit_private_address(monkeypatch):
+    """Mock the unit's private address."""
+    mocked_address = mock.Mock()
+    mocked_address.return_value = "10.0.0.10"
+    monkeypatch.setattr("libgitlab.hookenv.unit_private_ip", mocked_address)
+    return mocked_address
+
+
+@pytest.fixture
+def mock_local_unit(monkeypatch):
+    """Mock the name of the local unit."""
+    monkeypatch.setattr("libgitlab.hookenv.local_unit", lambda: "gitlab/0")
+
+
 @pytest.fixture
 def mock_apt_install(monkeypatch):
     """Mock the charmhelper fetch apt_install method."""
@@ -189,6 +234,7 @@ def mock_add_source(monkeypatch):
 def mock_gitlab_subprocess(monkeypatch):
     """Mock subprocess import on libgitlab."""
     mock_subprocess = mock.Mock()
+    mock_subprocess.check_output.return_value = b""
     monkeypatch.setattr("libgitlab.subprocess", mock_subprocess)
     return mock_subprocess
 
@@ -217,6 +263,8 @@ def libgitlab(
     mock_charm_dir,
     mock_upgrade_package,
     mock_gitlab_socket,
+    mock_unit_private_address,
+    mock_local_unit,
     mock_apt_install,
     mock_apt_update,
     mock_add_source,
@@ -243,10 +291,12 @@ def libgitlab(
     gitlab.gitlab_commands_file = commands_file.strpath
     config_file = tmpdir.join("gitlab.rb")
     gitlab.gitlab_config = config_file.strpath
+    gitlab.charm_config["metrics_textfile_dir"] = tmpdir.strpath
 
     # Mock host functions not appropriate for unit testing
     gitlab.fetch_gitlab_apt_package = mock.Mock()
     gitlab.gitlab_reconfigure_run = mock.Mock()
+    gitlab.get_gitlab_version = mock.Mock(return_value=(13, 4))
 
     # Any other functions that load the helper will get this version
     monkeypatch.setattr("libgitlab.GitlabHelper", lambda: gitlab)
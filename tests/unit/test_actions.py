@@ -13,6 +13,15 @@ def test_reconfigure_action(libgitlab, monkeypatch):
     assert mock_function.call_count == 1
 
 
+def test_reconfigure_action_invalid_options(libgitlab, mock_action_fail):
+    """Test the reconfigure action fails with the reason when options are invalid."""
+    libgitlab.charm_config["housekeeping_window"] = "01:00"
+    imp.load_source("configure", "./actions/reconfigure")
+    assert mock_action_fail.call_args == mock.call(
+        "GitLab was not reconfigured: housekeeping_window must be HH:MM-HH:MM, e.g. 01:00-05:00"
+    )
+
+
 def test_upgrade_action(libgitlab, monkeypatch):
     """Test reconfiguration of GitLab."""
     mock_function = mock.Mock()
@@ -22,13 +31,15 @@ def test_upgrade_action(libgitlab, monkeypatch):
     assert mock_function.call_count == 1
 
 
-def test_migrate_db_action(libgitlab, monkeypatch):
+def test_migrate_db_action(libgitlab, monkeypatch, mock_action_get):
     """Test migration of GitLab data."""
     mock_function = mock.Mock()
     monkeypatch.setattr(libgitlab, "migrate_db", mock_function)
+    mock_action_get.update({"workers": 8})
     assert mock_function.call_count == 0
     imp.load_source("migratedb", "./actions/migratedb")
     assert mock_function.call_count == 1
+    assert mock_function.call_args == mock.call({"workers": 8})
 
 
 def test_backup_action(libgitlab, monkeypatch):
@@ -38,3 +49,64 @@ def test_backup_action(libgitlab, monkeypatch):
     assert mock_function.call_count == 0
     imp.load_source("backup", "./actions/backup")
     assert mock_function.call_count == 1
+
+
+def test_restore_action(libgitlab, monkeypatch, mock_action_get, mock_action_set):
+    """Test restore action."""
+    mock_function = mock.Mock()
+    mock_function.return_value = {"timings": {"restore": 1.0}, "verified": True}
+    monkeypatch.setattr(libgitlab, "restore", mock_function)
+    mock_action_get.update({"backup-id": "1600000000", "concurrency": 8})
+    assert mock_function.call_count == 0
+    imp.load_source("restore", "./actions/restore")
+    assert mock_function.call_count == 1
+    assert mock_function.call_args[1]["backup_id"] == "1600000000"
+    assert mock_function.call_args[1]["concurrency"] == 8
+    mock_action_set.assert_has_calls(
+        [mock.call({"verified": True}), mock.call({"timings.restore": 1.0})],
+        any_order=True,
+    )
+
+
+def test_restore_action_failed_checks(libgitlab, monkeypatch, mock_action_get, mock_action_set, mock_action_fail):
+    """Test restore action fails when GitLab didn't reconfigure or verify after restoring."""
+    monkeypatch.setattr(libgitlab, "restore", mock.Mock(return_value={"reconfigured": True, "verified": False}))
+    imp.load_source("restore", "./actions/restore")
+    assert mock_action_fail.call_args == mock.call("GitLab restored, but the integrity checks failed")
+    monkeypatch.setattr(libgitlab, "restore", mock.Mock(return_value={"reconfigured": False, "verified": True}))
+    imp.load_source("restore", "./actions/restore")
+    assert mock_action_fail.call_args == mock.call("GitLab restored, but gitlab-ctl reconfigure failed")
+
+
+def test_refresh_runner_token_action(libgitlab, monkeypatch, mock_action_get):
+    """Test refresh-runner-token action."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "refresh_runner_token", mock_function)
+    mock_action_get["rotate"] = True
+    imp.load_source("refresh_runner_token", "./actions/refresh-runner-token")
+    assert mock_function.call_args == mock.call(True)
+
+
+def test_diagnose_action(libgitlab, monkeypatch, mock_action_get, mock_action_set):
+    """Test diagnose action."""
+    mock_function = mock.Mock()
+    mock_function.return_value = {"results": {"redis": {"avg-ms": 0.2}}, "tarball": "/tmp/d.tar.gz"}
+    monkeypatch.setattr(libgitlab, "diagnose", mock_function)
+    mock_action_get.update({"timeout": 10})
+    imp.load_source("diagnose", "./actions/diagnose")
+    assert mock_function.call_args == mock.call(timeout=10)
+    mock_action_set.assert_has_calls(
+        [mock.call({"results.redis.avg-ms": 0.2}), mock.call({"tarball": "/tmp/d.tar.gz"})],
+        any_order=True,
+    )
+
+
+def test_housekeeping_action(libgitlab, monkeypatch, mock_action_get, mock_action_set):
+    """Test housekeeping action."""
+    mock_function = mock.Mock()
+    mock_function.return_value = {"scheduled": "group/a, group/b"}
+    monkeypatch.setattr(libgitlab, "run_housekeeping", mock_function)
+    mock_action_get["projects"] = "group/a  group/b"
+    imp.load_source("housekeeping", "./actions/housekeeping")
+    assert mock_function.call_args == mock.call(["group/a", "group/b"])
+    mock_action_set.assert_called_once_with({"scheduled": "group/a, group/b"})
@@ -1,9 +1,21 @@
 #!/usr/bin/python3
 """Test helper library usage."""
 
+import hashlib
+import io
+import json
+import os
+import re
+import socket
+import subprocess
+import tarfile
+import threading
+import time
+
 import mock
 import pytest
 from charmhelpers.core import unitdata
+from libgitlab import RailsQueryError, RedisError
 from mock import call
 
 
@@ -126,6 +138,257 @@ def test_configure_proxy(libgitlab, external_url, proxy_ssh_port, ssh_port):
     )
 
 
+def _serve_rails_queries(path, responses):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def serve():
+        for response in responses:
+            client, _ = server.accept()
+            client.recv(1024)
+            client.sendall(json.dumps(response).encode("utf-8"))
+            client.close()
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return thread
+
+
+def test_rails_query(libgitlab, tmpdir, monkeypatch):
+    """Test queries are answered by a running Rails query server."""
+    monkeypatch.setattr("libgitlab.socket", socket)
+    libgitlab.rails_query_socket = tmpdir.join("rails.socket").strpath
+    thread = _serve_rails_queries(
+        libgitlab.rails_query_socket,
+        [{"result": {"default": {"size": 1}}}, {"error": "boom"}],
+    )
+    assert libgitlab.rails_query("application_settings") == {"default": {"size": 1}}
+    with pytest.raises(RailsQueryError):
+        libgitlab.rails_query("runner_token")
+    with pytest.raises(RailsQueryError):
+        libgitlab.rails_query("destroy_everything")
+    thread.join()
+
+
+def test_rails_query_starts_server(libgitlab, tmpdir, monkeypatch):
+    """Test the Rails query server is started when it isn't running."""
+    monkeypatch.setattr("libgitlab.socket", socket)
+    libgitlab.rails_query_socket = tmpdir.join("rails.socket").strpath
+    libgitlab.rails_query_script = tmpdir.join("rails-query-server.rb").strpath
+    threads = []
+    libgitlab.start_rails_query_server = mock.Mock()
+    libgitlab.start_rails_query_server.side_effect = lambda: threads.append(
+        _serve_rails_queries(libgitlab.rails_query_socket, [{"result": "token"}])
+    )
+    assert libgitlab.rails_query("runner_token") == "token"
+    assert libgitlab.start_rails_query_server.call_count == 1
+    threads[0].join()
+
+
+def test_rails_query_without_wait(libgitlab, tmpdir, monkeypatch):
+    """Test a query which would wait for Rails to boot starts the server and fails fast."""
+    monkeypatch.setattr("libgitlab.socket", socket)
+    libgitlab.rails_query_socket = tmpdir.join("rails.socket").strpath
+    libgitlab.start_rails_query_server = mock.Mock()
+    with pytest.raises(RailsQueryError):
+        libgitlab.rails_query("background_migrations", wait=False)
+    assert libgitlab.start_rails_query_server.call_args == call(wait=False)
+
+
+def test_start_rails_query_server(libgitlab, tmpdir, mock_gitlab_subprocess):
+    """Test the Rails query server script is rendered and run with gitlab-rails."""
+    libgitlab.rails_query_socket = tmpdir.join("rails.socket").strpath
+    libgitlab.rails_query_script = tmpdir.join("rails-query-server.rb").strpath
+    mock_gitlab_subprocess.Popen.side_effect = lambda *args, **kwargs: tmpdir.join(
+        "rails.socket"
+    ).write("")
+    libgitlab.start_rails_query_server()
+    cmd = mock_gitlab_subprocess.Popen.call_args[0][0]
+    assert cmd[:2] == ["/usr/bin/gitlab-rails", "runner"]
+    assert cmd[-1] == libgitlab.rails_query_script
+    with open(libgitlab.rails_query_script, "r") as script:
+        content = script.read().splitlines()
+    assert "SOCKET_PATH = '{}'.freeze".format(libgitlab.rails_query_socket) in content
+    assert "IDLE_TIMEOUT = 900" in content
+
+
+def test_get_runner_token(libgitlab):
+    """Test the runner token is cached until invalidated."""
+    libgitlab.rails_query = mock.Mock()
+    libgitlab.rails_query.return_value = "token1"
+    assert libgitlab.get_runner_token() == "token1"
+    assert libgitlab.get_runner_token() == "token1"
+    assert libgitlab.rails_query.call_args_list == [call("runner_token")]
+
+    libgitlab.rails_query.return_value = "token2"
+    libgitlab.invalidate_runner_token()
+    assert libgitlab.get_runner_token() == "token2"
+    assert libgitlab.rails_query.call_count == 2
+
+
+def test_check_runner_token(libgitlab):
+    """Test a stale cached runner token is replaced by GitLab's."""
+    libgitlab.rails_query = mock.Mock(return_value="current")
+    libgitlab.kv.set("runner_token", "current")
+    assert libgitlab.check_runner_token() is False
+    libgitlab.kv.set("runner_token", "stale")
+    assert libgitlab.check_runner_token() is True
+    assert libgitlab.kv.get("runner_token") == "current"
+
+
+def test_refresh_runner_token(libgitlab, mock_gitlab_subprocess):
+    """Test refreshing the runner token, with and without rotation."""
+    libgitlab.rails_query = mock.Mock()
+    libgitlab.rails_query.return_value = "fresh"
+    libgitlab.kv.set("runner_token", "cached")
+    libgitlab.kv.set("runner_published", {"runner:1": {}})
+    assert libgitlab.refresh_runner_token() == "fresh"
+    assert libgitlab.rails_query.call_count == 1
+    assert mock_gitlab_subprocess.check_output.call_count == 0
+    assert libgitlab.kv.get("runner_published") is None
+
+    assert libgitlab.refresh_runner_token(rotate=True) == "fresh"
+    script = mock_gitlab_subprocess.check_output.call_args[0][0][-1]
+    assert script.endswith("reset_runners_registration_token!")
+    assert libgitlab.rails_query.call_count == 2
+
+
+def _runner_relation(relation_id, *units):
+    relation = mock.Mock()
+    relation.relation_id = relation_id
+    relation.joined_units = []
+    for unit_name in units:
+        unit = mock.Mock()
+        unit.unit_name = unit_name
+        relation.joined_units.append(unit)
+    return relation
+
+
+def test_publish_runner_config(libgitlab):
+    """Test runner config is published once for every pending relation."""
+    libgitlab.kv.set("runner_token", "token")
+    endpoint = mock.Mock()
+    endpoint.relations = [
+        _runner_relation("runner:1", "runner-a/0"),
+        _runner_relation("runner:2", "runner-b/0", "runner-b/1"),
+    ]
+    assert libgitlab.publish_runner_config(endpoint) == ["runner:1", "runner:2"]
+    assert endpoint.publish.call_args == call("http://mock.example.com", "token")
+
+    # Nothing pending
+    endpoint.publish.reset_mock()
+    assert libgitlab.publish_runner_config(endpoint) == []
+    assert endpoint.publish.call_count == 0
+
+    # Late joining unit and relation
+    endpoint.relations[0] = _runner_relation("runner:1", "runner-a/0", "runner-a/1")
+    endpoint.relations.append(_runner_relation("runner:3", "runner-c/0"))
+    assert libgitlab.publish_runner_config(endpoint) == ["runner:1", "runner:3"]
+    assert endpoint.publish.call_count == 1
+
+    # Changed token
+    libgitlab.kv.set("runner_token", "rotated")
+    assert libgitlab.publish_runner_config(endpoint) == [
+        "runner:1",
+        "runner:2",
+        "runner:3",
+    ]
+    assert endpoint.publish.call_args == call("http://mock.example.com", "rotated")
+
+
+def test_get_runner_uri(libgitlab, mock_gitlab_subprocess, monkeypatch):
+    """Test runners use the runner binding address when bypassing the proxy."""
+    mock_network_get = mock.Mock()
+    mock_network_get.return_value = {"ingress-addresses": ["10.0.1.5", "10.0.2.5"]}
+    monkeypatch.setattr("libgitlab.hookenv.network_get", mock_network_get)
+    libgitlab.charm_config["external_url"] = "https://gitlab.example.com"
+    assert libgitlab.get_runner_uri() == "https://gitlab.example.com"
+    assert mock_network_get.call_count == 0
+
+    libgitlab.charm_config["runners_bypass_proxy"] = True
+    assert libgitlab.get_runner_uri() == "http://10.0.1.5"
+    assert mock_network_get.call_args == call("runner")
+    libgitlab.charm_config["http_port"] = 8080
+    assert libgitlab.get_runner_uri() == "http://10.0.1.5:8080"
+
+    # Fall back to the fqdn without a binding address
+    libgitlab.charm_config["http_port"] = 80
+    libgitlab.invalidate_network_identity()
+    mock_network_get.return_value = {"ingress-addresses": []}
+    assert libgitlab.get_runner_uri() == "http://mock.example.com"
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_network_get.side_effect = NotImplementedError
+    assert libgitlab.get_runner_uri() == "http://mock.example.com"
+
+
+def test_get_network_identity(libgitlab, mock_gitlab_socket, mock_unit_private_address):
+    """Test the FQDN is resolved once and cached until the unit address changes."""
+    assert libgitlab.get_fqdn() == "mock.example.com"
+    assert libgitlab.get_sshhost() == "mock.example.com"
+    assert libgitlab.get_external_uri() == "http://mock.example.com"
+    assert mock_gitlab_socket.getfqdn.call_count == 1
+
+    # A new hook uses the cached identity
+    libgitlab._network_identity = None
+    assert libgitlab.get_fqdn() == "mock.example.com"
+    assert mock_gitlab_socket.getfqdn.call_count == 1
+
+    # Address changes resolve again
+    libgitlab._network_identity = None
+    mock_unit_private_address.return_value = "10.0.0.20"
+    mock_gitlab_socket.getfqdn.return_value = "new.example.com"
+    assert libgitlab.get_fqdn() == "new.example.com"
+    assert mock_gitlab_socket.getfqdn.call_count == 2
+
+
+def test_get_network_identity_timeout(libgitlab, mock_gitlab_socket):
+    """Test a slow DNS lookup falls back to the last known FQDN and is retried."""
+    libgitlab.fqdn_timeout = 0.1
+    libgitlab.kv.set(
+        "network_identity",
+        {
+            "address": "10.0.0.1",
+            "fqdn": "old.example.com",
+            "resolved": True,
+            "bindings": {},
+        },
+    )
+    mock_gitlab_socket.getfqdn.side_effect = lambda: time.sleep(1)
+    assert libgitlab.get_fqdn() == "old.example.com"
+    assert libgitlab.kv.get("network_identity")["resolved"] is False
+
+    libgitlab.kv.unset("network_identity")
+    libgitlab._network_identity = None
+    mock_gitlab_socket.gethostname.return_value = "mock"
+    assert libgitlab.get_fqdn() == "mock"
+
+
+def test_forget_departed_runners(libgitlab):
+    """Test departed runner relations and units are no longer tracked."""
+    libgitlab.kv.set(
+        "runner_published",
+        {
+            "runner:1": {"uri": "uri", "token": "token", "units": ["a/0", "a/1"]},
+            "runner:2": {"uri": "uri", "token": "token", "units": ["b/0"]},
+        },
+    )
+    endpoint = mock.Mock()
+    endpoint.relations = [_runner_relation("runner:1", "a/0")]
+    libgitlab.forget_departed_runners(endpoint)
+    assert libgitlab.kv.get("runner_published") == {
+        "runner:1": {"uri": "uri", "token": "token", "units": ["a/0"]}
+    }
+
+
+def test_reconfigure_invalidates_runner_token(libgitlab, mock_gitlab_subprocess):
+    """Test every reconfigure invalidates the cached runner token, even with gitlab.rb unchanged."""
+    libgitlab.kv.set("runner_token", "cached")
+    assert type(libgitlab).gitlab_reconfigure_run(libgitlab) is True
+    assert libgitlab.kv.get("runner_token") is None
+
+
 def test_mysql_configured(libgitlab):
     """Test mysql_configured."""
     assert libgitlab.mysql_configured() is False
@@ -148,6 +411,51 @@ def test_legacy_db_configured(libgitlab):
     assert libgitlab.legacy_db_configured() is True
 
 
+def test_configure_apt_proxy(libgitlab, tmpdir):
+    """Test the APT proxy drop-in is written when a proxy is configured, and removed when not."""
+    libgitlab.apt_proxy_config = tmpdir.join("42juju-gitlab-proxy").strpath
+    libgitlab.charm_config["apt_http_proxy"] = "http://apt-cacher.example.com:3142"
+    libgitlab.add_sources()
+    with open(libgitlab.apt_proxy_config, "r") as proxy_config:
+        assert proxy_config.read().splitlines() == [
+            'Acquire::http::Proxy "http://apt-cacher.example.com:3142";'
+        ]
+    libgitlab.charm_config["apt_http_proxy"] = ""
+    libgitlab.configure_apt_proxy()
+    assert not tmpdir.join("42juju-gitlab-proxy").exists()
+
+
+def test_configure_sysctl(libgitlab, monkeypatch, tmpdir):
+    """Test kernel settings follow nginx's connections, never lower existing values, and apply on change."""
+    libgitlab.sysctl_config = tmpdir.join("50-juju-gitlab.conf").strpath
+    mock_create = mock.Mock(side_effect=lambda settings, path, ignore: open(path, "w").close())
+    monkeypatch.setattr("libgitlab.sysctl.create", mock_create)
+    current = {"net.core.somaxconn": 128, "fs.file-max": 9223372036854775807}
+    libgitlab.read_sysctl = mock.Mock(side_effect=lambda key: current.get(key))
+    libgitlab.charm_config["tuning_profile"] = "medium"
+    libgitlab.configure_sysctl()
+    settings = mock_create.call_args[0][0]
+    assert settings["net.core.somaxconn"] == 4096
+    assert settings["net.ipv4.tcp_max_syn_backlog"] == 4096
+    assert settings["fs.file-max"] == 9223372036854775807
+    assert settings["fs.inotify.max_user_watches"] == 524288
+    assert mock_create.call_args[0][1] == libgitlab.sysctl_config
+
+    # unchanged settings aren't reapplied, changed ones are
+    libgitlab.configure_sysctl()
+    assert mock_create.call_count == 1
+    libgitlab.charm_config["listen_backlog"] = 16384
+    libgitlab.configure_sysctl()
+    assert mock_create.call_args[0][0]["net.core.somaxconn"] == 16384
+    libgitlab.charm_config["manage_sysctl"] = False
+    libgitlab.charm_config["listen_backlog"] = 8192
+    libgitlab.configure_sysctl()
+    assert mock_create.call_count == 2
+    # the drop-in is removed, so its settings aren't applied at the next boot
+    assert not os.path.exists(libgitlab.sysctl_config)
+    assert libgitlab.kv.get("sysctl_settings") is None
+
+
 def test_install_pgloader(libgitlab, mock_apt_install):
     """Test install_pgloader."""
     libgitlab.install_pgloader()
@@ -181,6 +489,68 @@ def test_configure_pgloader(libgitlab):
         in content
     )
     assert b"ALTER SCHEMA 'mysql_db' RENAME TO 'public'\n" in content
+    assert not any(line.startswith(b"INCLUDING ONLY") for line in content)
+
+
+def test_get_pgloader_settings(libgitlab, monkeypatch):
+    """Test pgloader settings are sized from cores and RAM, and can be overridden."""
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 8)
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 16 * 1024 ** 3)
+    settings = libgitlab.get_pgloader_settings()
+    assert settings == {
+        "workers": 8,
+        "concurrency": 2,
+        "batch_rows": 50000,
+        "batch_size": 64,
+        "prefetch_rows": 100000,
+        "multiple_readers": True,
+        "rows_per_range": 50000,
+    }
+
+    settings = libgitlab.get_pgloader_settings(
+        {
+            "workers": 4,
+            "batch-size": 0,
+            "prefetch-rows": None,
+            "multiple-readers": False,
+        }
+    )
+    assert settings["workers"] == 4
+    assert settings["batch_size"] == 64
+    assert settings["prefetch_rows"] == 100000
+    assert settings["multiple_readers"] is False
+
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 1)
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 1024 ** 3)
+    settings = libgitlab.get_pgloader_settings({"multiple-readers": True})
+    assert settings["workers"] == 2
+    assert settings["batch_size"] == 4
+    assert settings["prefetch_rows"] == 65536
+    assert settings["multiple_readers"] is False
+
+
+def test_configure_pgloader_tuning(libgitlab, monkeypatch):
+    """Test pgloader tuning settings are rendered into commands.load."""
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 4)
+    libgitlab.configure_pgloader({"batch-rows": 1000, "batch-size": 8})
+    with open(libgitlab.gitlab_commands_file, "r") as commands_file:
+        content = commands_file.read().splitlines()
+    assert "     workers = 4, concurrency = 1," in content
+    assert "     batch rows = 1000, batch size = 8MB," in content
+    assert "     multiple readers per thread, rows per range = 50000," in content
+
+    libgitlab.configure_pgloader(None, ["issues", "users"])
+    with open(libgitlab.gitlab_commands_file, "r") as commands_file:
+        content = commands_file.read().splitlines()
+    assert "INCLUDING ONLY TABLE NAMES MATCHING 'issues', 'users'" in content
+    assert "BEFORE LOAD DO" not in content
+
+    libgitlab.configure_pgloader(None, ["issues"], ["issues", "users"])
+    with open(libgitlab.gitlab_commands_file, "r") as commands_file:
+        content = commands_file.read().splitlines()
+    assert 'BEFORE LOAD DO' in content
+    assert '$$ TRUNCATE TABLE "issues", "users" CASCADE; $$' in content
+    assert not any("truncate" in line for line in content if line.startswith("WITH"))
 
 
 def test_mysql_migrated(libgitlab):
@@ -194,8 +564,14 @@ def test_migrate_db(libgitlab):
     """Test migrate_db."""
     # No migration
     libgitlab.install_pgloader = mock.Mock()
+    libgitlab.install_mysql_client = mock.Mock()
+    libgitlab.finish_migration = mock.Mock()
+    libgitlab.finish_migration.return_value = True
     libgitlab.configure_pgloader = mock.Mock()
     libgitlab.run_pgloader = mock.Mock()
+    libgitlab.run_pgloader.return_value = {}
+    libgitlab.get_pending_migration_tables = mock.Mock()
+    libgitlab.get_pending_migration_tables.return_value = ["users"]
     libgitlab.migrate_db()
     assert libgitlab.install_pgloader.call_count == 0
     assert libgitlab.configure_pgloader.call_count == 0
@@ -218,8 +594,152 @@ def test_migrate_db(libgitlab):
     assert libgitlab.install_pgloader.call_count == 1
     assert libgitlab.configure_pgloader.call_count == 1
     assert libgitlab.run_pgloader.call_count == 1
+    assert libgitlab.finish_migration.call_count == 1
     assert libgitlab.kv.get("mysql_migration_run")
 
+    # Verification failed
+    libgitlab.kv.unset("mysql_migration_run")
+    libgitlab.finish_migration.return_value = False
+    assert libgitlab.migrate_db() is False
+    assert not libgitlab.kv.get("mysql_migration_run")
+
+
+def test_migrate_db_failed_tables(libgitlab):
+    """Test migrate_db does not complete while tables have errors."""
+    _configure_database("mysql", libgitlab)
+    _configure_database("pgsql", libgitlab)
+    libgitlab.install_pgloader = mock.Mock()
+    libgitlab.install_mysql_client = mock.Mock()
+    libgitlab.migrate_tables = mock.Mock()
+    libgitlab.migrate_tables.return_value = ["users"]
+    libgitlab.get_pending_migration_tables = mock.Mock()
+    libgitlab.get_pending_migration_tables.return_value = ["projects", "users"]
+    libgitlab.kv.set("mysql_migrated_tables", ["issues"])
+    assert libgitlab.migrate_db({"restart": True, "tables-per-run": 10}) is False
+    assert libgitlab.migrate_tables.call_args[0][0] == ["projects", "users"]
+    assert libgitlab.migrate_tables.call_args[0][2] == 10
+    assert libgitlab.kv.get("mysql_migrated_tables") is None
+    assert not libgitlab.kv.get("mysql_migration_run")
+
+
+def test_migrate_db_pgloader_failed(libgitlab, mock_gitlab_subprocess):
+    """Test migrate_db blocks instead of raising when pgloader fails."""
+    _configure_database("mysql", libgitlab)
+    _configure_database("pgsql", libgitlab)
+    libgitlab.install_pgloader = mock.Mock()
+    libgitlab.install_mysql_client = mock.Mock()
+    libgitlab.get_pending_migration_tables = mock.Mock(return_value=["users"])
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    libgitlab.migrate_tables = mock.Mock(side_effect=subprocess.CalledProcessError(1, "pgloader"))
+    assert libgitlab.migrate_db() is False
+    assert not libgitlab.kv.get("mysql_migration_run")
+
+
+def test_migrate_tables(libgitlab):
+    """Test tables are migrated in batches and completed tables are recorded."""
+    libgitlab.configure_pgloader = mock.Mock()
+    libgitlab.run_pgloader = mock.Mock()
+    libgitlab.run_pgloader.side_effect = [
+        {"issues": {"errors": 0, "rows": 10}, "projects": {"errors": 2, "rows": 8}},
+        {"users": {"errors": 0, "rows": 3}},
+    ]
+    failed = libgitlab.migrate_tables(["issues", "projects", "users"], None, 2)
+    assert failed == ["projects"]
+    assert libgitlab.configure_pgloader.call_args_list == [
+        call(None, ["issues", "projects"], ["issues", "projects", "users"]),
+        call(None, ["users"], None),
+    ]
+    assert libgitlab.kv.get("mysql_migrated_tables") == ["issues", "users"]
+
+
+def test_get_pending_migration_tables(libgitlab, mock_gitlab_subprocess):
+    """Test tables already migrated are skipped."""
+    _configure_database("pgsql", libgitlab)
+    mock_gitlab_subprocess.check_output.side_effect = [
+        b"issues\nlists\nnotes\nprojects\nusers\n",
+        b"lists\tprojects\nnotes\tlists\nissues\tusers\n",
+    ]
+    libgitlab.kv.set("mysql_migrated_tables", ["issues", "lists", "notes", "users"])
+    # lists references projects, and notes references lists
+    assert libgitlab.get_pending_migration_tables() == ["lists", "notes", "projects"]
+    cmd = mock_gitlab_subprocess.check_output.call_args[0][0]
+    assert cmd[0] == "/opt/gitlab/bin/psql"
+    env = mock_gitlab_subprocess.check_output.call_args[1]["env"]
+    assert env["PGPASSWORD"] == "pass"
+
+
+def _mock_row_counts(command, env, timeout=None):
+    query = command[-1]
+    if query == "SHOW TABLES":
+        return b"issues\nprojects\nusers\n"
+    if command[0] == "/usr/bin/mysql" and "`projects`" in query:
+        return b"5\n"
+    return b"3\n"
+
+
+def test_verify_row_counts(libgitlab, mock_gitlab_subprocess):
+    """Test row counts are compared between MySQL and PostgreSQL."""
+    _configure_database("mysql", libgitlab)
+    _configure_database("pgsql", libgitlab)
+    mock_gitlab_subprocess.check_output.side_effect = _mock_row_counts
+    libgitlab.kv.set("mysql_migrated_tables", ["issues", "projects", "schema_only"])
+    report = libgitlab.verify_row_counts(2)
+    assert report == {
+        "tables": {
+            "issues": {"mysql": 3, "pgsql": 3},
+            "projects": {"mysql": 5, "pgsql": 3},
+        },
+        "mismatched": ["projects"],
+    }
+
+
+@pytest.mark.parametrize(
+    "analyze,statement",
+    (("analyze", "ANALYZE"), ("vacuum-analyze", "VACUUM ANALYZE"), ("none", None)),
+)
+def test_finish_migration(libgitlab, mock_gitlab_subprocess, analyze, statement):
+    """Test the migrated database is analyzed and mismatched tables marked for reload."""
+    _configure_database("mysql", libgitlab)
+    _configure_database("pgsql", libgitlab)
+    mock_gitlab_subprocess.check_output.side_effect = _mock_row_counts
+    libgitlab.kv.set("mysql_migrated_tables", ["issues", "projects"])
+    assert libgitlab.finish_migration({"analyze": analyze}) is False
+    queries = [c[0][0][-1] for c in mock_gitlab_subprocess.check_output.call_args_list]
+    assert ("ANALYZE" in queries) == (statement == "ANALYZE")
+    assert ("VACUUM ANALYZE" in queries) == (statement == "VACUUM ANALYZE")
+    assert libgitlab.kv.get("mysql_migration_report")["mismatched"] == ["projects"]
+    assert libgitlab.kv.get("mysql_migrated_tables") == ["issues"]
+    # the report and reload list survive the action exiting without a flush
+    libgitlab.kv.flush(save=False)
+    assert libgitlab.kv.get("mysql_migration_report")["mismatched"] == ["projects"]
+    assert libgitlab.kv.get("mysql_migrated_tables") == ["issues"]
+
+    libgitlab.kv.set("mysql_migrated_tables", ["issues"])
+    assert libgitlab.finish_migration({"analyze": "none"}) is True
+
+
+def test_run_pgloader(libgitlab, mock_gitlab_subprocess):
+    """Test pgloader output is streamed and the per table summary parsed."""
+    process = mock_gitlab_subprocess.Popen.return_value
+    process.stdout = [
+        "2020-09-01T00:00:00.000000Z LOG Migrating from #<MYSQL-CONNECTION>\n",
+        "             table name     errors       rows      bytes      total time\n",
+        "        fetch meta data          0          2                     0.100s\n",
+        "           public.users          0        123    12.0 kB          0.200s\n",
+        '     "public"."projects"          1         45     4.0 kB          0.100s\n',
+    ]
+    process.wait.return_value = 0
+    assert libgitlab.run_pgloader() == {
+        "users": {"errors": 0, "rows": 123},
+        "projects": {"errors": 1, "rows": 45},
+    }
+
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    process.wait.return_value = 1
+    process.returncode = 1
+    with pytest.raises(subprocess.CalledProcessError):
+        libgitlab.run_pgloader()
+
 
 def test_migrate_mysql_config(libgitlab):
     """Test migrate_mysql_config."""
@@ -401,6 +921,78 @@ def test_upgrade_gitlab_install(libgitlab, mock_gitlab_hookenv_log):
     assert result is True
 
 
+def test_package_resource_cache(libgitlab, tmpdir, mock_gitlab_subprocess, monkeypatch):
+    """Test the gitlab-package resource is verified, cached and preferred when its version matches."""
+    resource = tmpdir.join("gitlab.deb")
+    resource.write_binary(b"deb contents")
+    libgitlab.package_cache_dir = tmpdir.join("cache").strpath
+    monkeypatch.setattr("libgitlab.hookenv.resource_get", lambda name: resource.strpath)
+    libgitlab.charm_config["package_sha256"] = hashlib.sha256(b"deb contents").hexdigest()
+    monkeypatch.setattr(
+        "libgitlab.ubuntu_apt_pkg.version_compare",
+        lambda a, b: (a > b) - (a < b),
+    )
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_gitlab_subprocess.check_output.side_effect = [
+        b"Package: gitlab-ce\nVersion: 13.4.1-ce.0\nArchitecture: amd64\n",
+        subprocess.CalledProcessError(1, "dpkg-query"),
+    ]
+    cached = tmpdir.join("cache", "gitlab-ce_13.4.1-ce.0_amd64.deb").strpath
+    assert libgitlab.get_cached_package("13.4.1-ce.0") == cached
+    with open(cached, "rb") as package:
+        assert package.read() == b"deb contents"
+    # an unchanged resource isn't inspected again
+    mock_gitlab_subprocess.check_output.side_effect = [b"13.4.1-ce.0"]
+    assert libgitlab.get_cached_package("13.4.1-ce.0") == cached
+    mock_gitlab_subprocess.check_output.side_effect = None
+    # only the exact version being installed is used
+    assert libgitlab.get_cached_package("13.12.0-ce.0") is None
+
+    # a newer installed version isn't downgraded
+    mock_gitlab_subprocess.check_output.return_value = b"13.5.0-ce.0"
+    assert libgitlab.get_cached_package("13.4.1-ce.0") is None
+
+    # tampered cache entries are skipped
+    mock_gitlab_subprocess.check_output.return_value = b""
+    with open(cached, "wb") as package:
+        package.write(b"tampered")
+    assert libgitlab.get_cached_package("13.4.1-ce.0") is None
+
+
+def test_get_package_target(libgitlab, monkeypatch):
+    """Test the cache is only used for the exact version option or apt candidate being installed."""
+    apt_cache = {"gitlab-ce": mock.Mock(version="13.12.0-ce.0")}
+    monkeypatch.setattr("libgitlab.ubuntu_apt_pkg.Cache", lambda: apt_cache)
+    assert libgitlab.get_package_target() == "13.12.0-ce.0"
+    assert libgitlab.get_package_target("13.*") == "13.12.0-ce.0"
+    # intermediate major upgrades go to apt
+    assert libgitlab.get_package_target("12.*") is None
+    libgitlab.charm_config["version"] = "13.4.1-ce.0"
+    assert libgitlab.get_package_target("13.*") == "13.4.1-ce.0"
+    libgitlab.charm_config["version"] = ""
+    del apt_cache["gitlab-ce"]
+    assert libgitlab.get_package_target("13.*") is None
+
+
+def test_package_resource_checksum_required(libgitlab, tmpdir, monkeypatch):
+    """Test a resource is never cached without package_sha256 to verify it against."""
+    resource = tmpdir.join("gitlab.deb")
+    resource.write_binary(b"deb contents")
+    monkeypatch.setattr("libgitlab.hookenv.resource_get", lambda name: resource.strpath)
+    assert libgitlab.import_package_resource() is None
+    assert libgitlab.kv.get("package_cache") is None
+
+
+def test_package_resource_checksum_mismatch(libgitlab, tmpdir, monkeypatch):
+    """Test a resource which doesn't match package_sha256 is never cached."""
+    resource = tmpdir.join("gitlab.deb")
+    resource.write_binary(b"deb contents")
+    monkeypatch.setattr("libgitlab.hookenv.resource_get", lambda name: resource.strpath)
+    libgitlab.charm_config["package_sha256"] = "0" * 64
+    assert libgitlab.import_package_resource() is None
+    assert libgitlab.kv.get("package_cache") is None
+
+
 def test_backup(libgitlab, mock_gitlab_subprocess, mock_layers):
     """Test backup."""
     libgitlab.backup()
@@ -408,6 +1000,308 @@ def test_backup(libgitlab, mock_gitlab_subprocess, mock_layers):
     assert mock_layers["layer_backup"].call_count == 1
 
 
+def test_restore(libgitlab, mock_gitlab_subprocess):
+    """Test restore stops only the required services and reconfigures once."""
+    libgitlab.gitlab_reconfigure_run.return_value = True
+    libgitlab.kv.set("runner_token", "cached")
+    results = libgitlab.restore(
+        backup_id="1600000000", concurrency=8, storage_concurrency=2, skip="registry"
+    )
+    commands = [c[0][0] for c in mock_gitlab_subprocess.check_output.call_args_list]
+    assert commands == [
+        ["/usr/bin/gitlab-ctl", "stop", "puma"],
+        ["/usr/bin/gitlab-ctl", "stop", "sidekiq"],
+        [
+            "/usr/bin/gitlab-backup",
+            "restore",
+            "force=yes",
+            "BACKUP=1600000000",
+            "SKIP=registry",
+        ],
+        ["/usr/bin/gitlab-ctl", "start", "puma"],
+        ["/usr/bin/gitlab-ctl", "start", "sidekiq"],
+        ["/usr/bin/gitlab-rake", "gitlab:check", "SANITIZE=true"],
+        ["/usr/bin/gitlab-rake", "gitlab:doctor:secrets"],
+    ]
+    env = mock_gitlab_subprocess.check_output.call_args_list[2][1]["env"]
+    assert env["GITLAB_BACKUP_MAX_CONCURRENCY"] == "8"
+    assert env["GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY"] == "2"
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+    assert libgitlab.kv.get("runner_token") is None
+    assert results["reconfigured"] is True
+    assert results["verified"] is True
+    assert set(results["timings"]) == {
+        "stop",
+        "restore",
+        "reconfigure",
+        "start",
+        "verify",
+        "total",
+    }
+
+
+def test_set_action_results(libgitlab, mock_action_set):
+    """Test nested action results are flattened into dotted keys."""
+    libgitlab.set_action_results({"outcome": "ok", "timings": {"restore": 1.5}})
+    mock_action_set.assert_has_calls(
+        [call({"timings.restore": 1.5}), call({"outcome": "ok"})]
+    )
+
+
+def test_record_operation(libgitlab, tmpdir):
+    """Test operation durations and outcomes are accumulated and written to the textfile."""
+    libgitlab.record_operation("reconfigure", 42.5, True)
+    with pytest.raises(RuntimeError):
+        with libgitlab.operation_timer("reconfigure"):
+            raise RuntimeError("reconfigure failed")
+    metric = libgitlab.kv.get("operation_metrics")["reconfigure"]
+    assert metric["count"] == 2
+    assert metric["outcomes"] == {"success": 1, "failure": 1}
+    assert metric["buckets"][:4] == [1, 1, 1, 1]
+    assert metric["buckets"][4:] == [2] * 6
+
+    lines = tmpdir.join("juju_gitlab.prom").read().splitlines()
+    labels = 'unit="gitlab/0",operation="reconfigure"'
+    assert 'juju_gitlab_operation_duration_seconds_bucket{{{},le="60"}} 2'.format(labels) in lines
+    assert 'juju_gitlab_operation_duration_seconds_bucket{{{},le="+Inf"}} 2'.format(labels) in lines
+    assert "juju_gitlab_operation_duration_seconds_count{{{}}} 2".format(labels) in lines
+    assert 'juju_gitlab_operations_total{{{},outcome="failure"}} 1'.format(labels) in lines
+    # the textfile is replaced atomically, leaving no temporary files behind
+    assert tmpdir.listdir(lambda path: path.basename.startswith(".juju_gitlab")) == []
+
+
+def test_record_hook(libgitlab, monkeypatch):
+    """Test failed hooks are committed as failures alone, keeping the operations they recorded."""
+    monkeypatch.setattr("libgitlab.hookenv.hook_name", lambda: "config-changed")
+    libgitlab.record_hook(True)
+    libgitlab.kv.flush()
+    libgitlab.kv.set("pgsql_host", "host")
+    libgitlab.record_operation("reconfigure", 42.5, False)
+    libgitlab.record_hook(False)
+    # anything left uncommitted when the hook exits is lost
+    libgitlab.kv.flush(save=False)
+    metrics = libgitlab.kv.get("operation_metrics")
+    assert metrics["hook:config-changed"]["outcomes"] == {"success": 1, "failure": 1}
+    assert metrics["reconfigure"]["outcomes"] == {"success": 0, "failure": 1}
+    assert libgitlab.kv.get("pgsql_host") is None
+
+
+def test_upgrade_recorded(libgitlab, mock_gitlab_subprocess):
+    """Test upgrades, their package steps and reconfigures are recorded as operations."""
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_gitlab_subprocess.check_output.side_effect = subprocess.CalledProcessError(1, "gitlab-ctl")
+    assert type(libgitlab).gitlab_reconfigure_run(libgitlab) is False
+    libgitlab.upgrade_gitlab()
+    metrics = libgitlab.kv.get("operation_metrics")
+    assert metrics["reconfigure"]["outcomes"] == {"success": 0, "failure": 1}
+    assert metrics["upgrade"]["count"] == 1
+
+
+def test_get_service_status(libgitlab, mock_gitlab_subprocess):
+    """Test runit service states are parsed from gitlab-ctl status, even when it fails."""
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_gitlab_subprocess.TimeoutExpired = subprocess.TimeoutExpired
+    mock_gitlab_subprocess.check_output.side_effect = subprocess.CalledProcessError(
+        6,
+        "gitlab-ctl",
+        output=b"run: puma: (pid 12) 300s; run: log: (pid 10) 400s\n"
+        b"down: sidekiq: 3s, normally up; run: log: (pid 11) 400s\n",
+    )
+    assert libgitlab.get_service_status() == {"puma": "run", "sidekiq": "down"}
+    mock_gitlab_subprocess.check_output.side_effect = subprocess.TimeoutExpired(
+        "gitlab-ctl", 5
+    )
+    assert libgitlab.get_service_status() == {}
+
+
+def test_http_probe(libgitlab, monkeypatch):
+    """Test probes report the status, body and latency, and tolerate an unreachable GitLab."""
+    response = mock.Mock()
+    response.getcode.return_value = 200
+    response.read.return_value = b'{"status": "ok"}'
+    monkeypatch.setattr("libgitlab.urlopen", mock.Mock(return_value=response))
+    code, body, latency = libgitlab.http_probe("/-/liveness")
+    assert (code, body) == (200, {"status": "ok"})
+    assert latency >= 0
+    monkeypatch.setattr(
+        "libgitlab.urlopen", mock.Mock(side_effect=ConnectionRefusedError())
+    )
+    assert libgitlab.http_probe("/-/liveness")[:2] == (None, None)
+
+
+@pytest.mark.parametrize(
+    "liveness,readiness,services,state,message",
+    [
+        (
+            (200, None, 20),
+            (200, {"status": "ok", "db_check": [{"status": "ok"}]}, 45),
+            {"puma": "run", "sidekiq": "run"},
+            "active",
+            "healthy (ready in 45ms)",
+        ),
+        (
+            (200, None, 1500),
+            (200, {"status": "ok"}, 1600),
+            {"puma": "run"},
+            "active",
+            "GitLab slow: Puma slow (1500ms)",
+        ),
+        (
+            (200, None, 20),
+            (503, {"status": "failed", "gitaly_check": [{"status": "failed"}]}, 30),
+            {"puma": "run", "sidekiq": "down", "mattermost": "down"},
+            "blocked",
+            "GitLab degraded: Gitaly down, Sidekiq down",
+        ),
+        (
+            (None, None, 5000),
+            (None, None, 5000),
+            {},
+            "blocked",
+            "GitLab degraded: Puma down",
+        ),
+    ],
+)
+def test_get_health_status(libgitlab, liveness, readiness, services, state, message):
+    """Test the unit status names degraded components and their latency."""
+    libgitlab.http_probe = mock.Mock(side_effect=[liveness, readiness])
+    libgitlab.get_service_status = mock.Mock(return_value=services)
+    libgitlab.check_sidekiq_queues = mock.Mock(return_value=[])
+    assert libgitlab.get_health_status("healthy") == (state, message)
+    # results are cached briefly, so a second status doesn't probe again
+    assert libgitlab.get_health_status("healthy") == (state, message)
+    assert libgitlab.http_probe.call_count == 2
+
+
+def test_check_sidekiq_queues(libgitlab, monkeypatch):
+    """Test queues over the size or latency thresholds are named in the unit status."""
+    libgitlab.kv.set("redis_host", "localhost")
+    libgitlab.kv.set("redis_port", "6379")
+    monkeypatch.setattr("libgitlab.time.time", lambda: 1600000700.0)
+    redis = {
+        ("SMEMBERS", "resque:gitlab:queues"): ["default", "mailers", "pipeline_processing"],
+        ("LLEN", "resque:gitlab:queue:default"): 1500,
+        ("LINDEX", "resque:gitlab:queue:default", -1): '{"enqueued_at": 1600000687.5}',
+        ("LLEN", "resque:gitlab:queue:mailers"): 3,
+        # Sidekiq 8 records milliseconds
+        ("LINDEX", "resque:gitlab:queue:mailers", -1): '{"enqueued_at": 1600000079900}',
+        ("LLEN", "resque:gitlab:queue:pipeline_processing"): 0,
+        ("SMEMBERS", "queues"): [],
+    }
+    connection = mock.MagicMock()
+    connection.return_value.__enter__.return_value = lambda *args: redis[args]
+    libgitlab.redis_connection = connection
+    assert libgitlab.check_sidekiq_queues() == [("mailers", 3, 620), ("default", 1500, 12)]
+    assert connection.call_args == call(5, "localhost", "6379", None)
+
+    libgitlab.http_probe = mock.Mock(side_effect=[(200, None, 20), (200, {"status": "ok"}, 45)])
+    libgitlab.get_service_status = mock.Mock(return_value={"sidekiq": "run"})
+    assert libgitlab.get_health_status("healthy") == (
+        "active",
+        "GitLab slow: Sidekiq backlog mailers (3 jobs, 620s), default (1500 jobs, 12s)",
+    )
+
+    # An unreachable Redis doesn't fail update-status
+    connection.side_effect = OSError("connection refused")
+    assert libgitlab.check_sidekiq_queues() == []
+    libgitlab.charm_config["sidekiq_queue_size_threshold"] = 0
+    libgitlab.charm_config["sidekiq_queue_latency_threshold"] = 0
+    connection.reset_mock()
+    assert libgitlab.check_sidekiq_queues() == []
+    assert connection.call_count == 0
+
+
+def test_diagnose_sidekiq(libgitlab):
+    """Test Sidekiq's process and job counts are read from Redis within the diagnose timeout."""
+    redis = {
+        ("SMEMBERS", "resque:gitlab:queues"): ["default"],
+        ("LLEN", "resque:gitlab:queue:default"): 0,
+        ("SMEMBERS", "resque:gitlab:processes"): ["host:1", "host:2"],
+        ("HGET", "resque:gitlab:host:1", "busy"): "3",
+        ("HGET", "resque:gitlab:host:2", "busy"): None,
+        ("ZCARD", "resque:gitlab:schedule"): 4,
+        ("ZCARD", "resque:gitlab:retry"): 2,
+        ("ZCARD", "resque:gitlab:dead"): 1,
+    }
+    connection = mock.MagicMock()
+    connection.return_value.__enter__.return_value = lambda *args: redis.get(args, 0)
+    libgitlab.redis_connection = connection
+    stats, raw = libgitlab.diagnose_sidekiq(7, "localhost", "6379", "secret")
+    assert stats == {"processes": 2, "busy": 3, "enqueued": 0, "scheduled": 4, "retries": 2, "dead": 1}
+    assert connection.call_args == call(7, "localhost", "6379", "secret")
+
+
+def test_read_redis_reply(libgitlab):
+    """Test RESP replies are parsed, and error replies raised."""
+    reader = io.BytesIO(b"+OK\r\n:3\r\n$5\r\nhello\r\n$-1\r\n*2\r\n$1\r\na\r\n:1\r\n-ERR wrong\r\n")
+    assert [libgitlab.read_redis_reply(reader) for _ in range(5)] == ["OK", 3, "hello", None, ["a", 1]]
+    with pytest.raises(RedisError, match="ERR wrong"):
+        libgitlab.read_redis_reply(reader)
+    with pytest.raises(OSError):
+        libgitlab.read_redis_reply(reader)
+
+
+def test_diagnose(libgitlab, tmpdir):
+    """Test diagnostics run concurrently within the timeout and are saved to a tarball."""
+    libgitlab.diagnostics_dir = tmpdir.join("diagnostics").strpath
+    started = threading.Event()
+
+    def stuck(timeout):
+        started.set()
+        time.sleep(timeout * 3)
+
+    def broken(timeout):
+        raise OSError("connection refused")
+
+    libgitlab.get_diagnostics = mock.Mock(
+        return_value={
+            "redis": lambda timeout: ({"avg-ms": 0.2}, "+PONG"),
+            "gitaly": stuck,
+            "postgresql": broken,
+        }
+    )
+    diagnostics = libgitlab.diagnose(timeout=0.2)
+    assert started.is_set()
+    assert diagnostics["results"] == {
+        "redis": {"avg-ms": 0.2},
+        "gitaly": {"error": "timed out after 0.2s"},
+        "postgresql": {"error": "connection refused"},
+    }
+    with tarfile.open(diagnostics["tarball"]) as tarball:
+        names = sorted(name.split("/", 1)[1] for name in tarball.getnames())
+        assert names == ["redis.txt", "results.json"]
+
+
+def test_diagnose_gitaly_and_postgresql(libgitlab, mock_gitlab_subprocess, monkeypatch):
+    """Test in-flight Gitaly RPCs and PostgreSQL connection usage are summarised."""
+    metrics = (
+        "# TYPE grpc_server_started_total counter\n"
+        'grpc_server_started_total{grpc_method="FindCommit",grpc_service="gitaly.CommitService"} 12\n'
+        'grpc_server_handled_total{grpc_code="OK",grpc_method="FindCommit",grpc_service="gitaly.CommitService"} 9\n'
+        'grpc_server_started_total{grpc_method="PostUploadPack",grpc_service="gitaly.SmartHTTPService"} 4\n'
+        'grpc_server_handled_total{grpc_code="OK",grpc_method="PostUploadPack",'
+        'grpc_service="gitaly.SmartHTTPService"} 4\n'
+    )
+    response = mock.Mock()
+    response.read.return_value = metrics.encode("utf-8")
+    monkeypatch.setattr("libgitlab.urlopen", mock.Mock(return_value=response))
+    result, _ = libgitlab.diagnose_gitaly(5, "localhost:9236")
+    assert result == {"in-flight": 3, "busiest-method": "FindCommit"}
+
+    mock_gitlab_subprocess.check_output.side_effect = [
+        b"active\t12\nidle\t70\nidle in transaction\t3\n",
+        b"200\n",
+    ]
+    result, _ = libgitlab.diagnose_postgresql(5, (["psql", "-c"], {}))
+    assert result == {
+        "connections": 85,
+        "max-connections": 200,
+        "usage-percent": 42.5,
+        "states": {"active": 12, "idle": 70, "idle-in-transaction": 3},
+    }
+    assert mock_gitlab_subprocess.check_output.call_args[1]["timeout"] == 5
+
+
 def test_render_config_fails_without_db(libgitlab, mock_gitlab_hookenv_log):
     """Test render of configuration fails when DB is not configured."""
     assert libgitlab.render_config() is False
@@ -424,6 +1318,381 @@ def test_render_pgsql_config(libgitlab, mock_gitlab_hookenv_log):
     )
 
 
+def test_render_metrics_config(libgitlab, monkeypatch):
+    """Test exporters are only enabled, and the scrapers whitelisted, when GitLab is scraped."""
+    monkeypatch.setattr(
+        "libgitlab.hookenv.network_get",
+        mock.Mock(return_value={"ingress-addresses": ["10.0.3.5"]}),
+    )
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_exporter['enable'] = false" in config_lines
+    assert not any(line.startswith("gitlab_rails['monitoring_whitelist']") for line in config_lines)
+
+    libgitlab.kv.set("scrape_whitelist", ["10.0.3.0/24"])
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert (
+        "gitlab_rails['monitoring_whitelist'] = ['127.0.0.0/8', '::1/128', '10.0.3.0/24']"
+        in config_lines
+    )
+    assert "sidekiq['listen_address'] = \"10.0.3.5\"" in config_lines
+    assert "gitaly['prometheus_listen_addr'] = \"10.0.3.5:9236\"" in config_lines
+    assert "gitlab_exporter['enable'] = true" in config_lines
+    assert "prometheus['enable'] = false" in config_lines
+
+    # GitLab 16.0 dropped the flat gitaly keys
+    libgitlab.get_gitlab_version.return_value = (16, 5)
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitaly['configuration'][:prometheus_listen_addr] = \"10.0.3.5:9236\"" in config_lines
+    assert not any(line.startswith("gitaly['prometheus_listen_addr']") for line in config_lines)
+
+
+def test_configure_scrape(libgitlab, monkeypatch):
+    """Test scrapers are whitelisted from their egress subnets and every exporter is published."""
+    monkeypatch.setattr("libgitlab.hookenv.network_get", mock.Mock(return_value={}))
+    libgitlab.render_config = mock.Mock()
+    units = [
+        mock.Mock(received_raw={"egress-subnets": "10.0.3.7/32,10.0.4.0/24"}),
+        mock.Mock(received_raw={"ingress-address": "10.0.5.9"}),
+    ]
+    endpoint = mock.Mock(relations=[mock.Mock(joined_units=units)])
+    assert libgitlab.configure_scrape(endpoint) is True
+    assert libgitlab.kv.get("scrape_whitelist") == ["10.0.3.7/32", "10.0.4.0/24", "10.0.5.9"]
+    jobs = {c[1]["job_name"]: c[1]["job_data"] for c in endpoint.register_job.call_args_list}
+    assert set(jobs) == {"gitlab-rails", "gitlab-sidekiq", "gitaly", "gitlab-workhorse", "gitlab-exporter"}
+    assert jobs["gitlab-rails"]["metrics_path"] == "/-/metrics"
+    assert jobs["gitlab-rails"]["static_configs"] == [{"targets": ["10.0.0.10:80"]}]
+
+    # Unchanged scrapers don't reconfigure GitLab
+    assert libgitlab.configure_scrape(endpoint) is False
+    assert libgitlab.render_config.call_count == 1
+    libgitlab.remove_scrape()
+    assert libgitlab.kv.get("scrape_whitelist") is None
+    assert libgitlab.render_config.call_count == 2
+
+
+def test_get_tuning(libgitlab, monkeypatch):
+    """Test tuning profiles are chosen automatically and options override their values."""
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 4)
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 8 * 1024 ** 3)
+    # without tuning options, GitLab's stock settings are left alone
+    assert libgitlab.get_tuning() == []
+    libgitlab.charm_config["tuning_profile"] = "medium"
+    libgitlab.charm_config["sidekiq_concurrency"] = 30
+    tuning = dict(libgitlab.get_tuning())
+    assert tuning["puma['worker_processes']"] == 4
+    assert tuning["sidekiq['concurrency']"] == 30
+    assert tuning["gitlab_rails['db_pool']"] == 35
+    assert tuning["gitaly['ruby_num_workers']"] == 3
+    # gitaly-ruby is gone from GitLab 16.0
+    libgitlab.get_gitlab_version.return_value = (16, 5)
+    assert "gitaly['ruby_num_workers']" not in dict(libgitlab.get_tuning())
+    libgitlab.get_gitlab_version.return_value = (13, 4)
+
+    libgitlab.charm_config["tuning_profile"] = "auto"
+    libgitlab.charm_config["sidekiq_concurrency"] = 0
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 16)
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 24 * 1024 ** 3)
+    assert libgitlab.get_tuning_profile() == "medium"
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 32 * 1024 ** 3)
+    assert libgitlab.get_tuning_profile() == "large"
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 2)
+    assert libgitlab.get_tuning_profile() == "small"
+
+
+def test_get_puma_worker_memory_limit(libgitlab, monkeypatch):
+    """Test Puma workers share the RAM left after headroom, within bounds, unless overridden."""
+    monkeypatch.setattr("libgitlab.os.cpu_count", lambda: 4)
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 16 * 1024 ** 3)
+    # (16384MB - 4096MB - 2 * 300MB) / (4 workers + master)
+    assert libgitlab.get_puma_worker_memory_limit({}) == 2048
+    assert libgitlab.get_puma_worker_memory_limit({"puma_workers": 8}) == 1298
+    # no headroom is kept for gitaly-ruby from GitLab 16.0
+    libgitlab.get_gitlab_version.return_value = (16, 0)
+    assert libgitlab.get_puma_worker_memory_limit({"puma_workers": 8}) == 1365
+    libgitlab.get_gitlab_version.return_value = (13, 4)
+    libgitlab.charm_config["puma_memory_headroom_mb"] = 10240
+    assert libgitlab.get_puma_worker_memory_limit({}) == 1228
+    # shares at or below GitLab's stock limit leave it in place
+    libgitlab.charm_config["puma_memory_headroom_mb"] = 0
+    monkeypatch.setattr("libgitlab.host.get_total_ram", lambda: 8 * 1024 ** 3)
+    assert libgitlab.get_puma_worker_memory_limit({}) is None
+    assert "puma['per_worker_max_memory_mb']" not in dict(libgitlab.get_tuning())
+    libgitlab.charm_config["puma_per_worker_max_memory_mb"] = 1200
+    assert dict(libgitlab.get_tuning())["puma['per_worker_max_memory_mb']"] == 1200
+
+
+def test_render_tuning_config(libgitlab):
+    """Test the tuning profile is rendered into gitlab.rb."""
+    libgitlab.charm_config["tuning_profile"] = "large"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "puma['worker_processes'] = 8" in config_lines
+    assert "nginx['worker_connections'] = 10240" in config_lines
+    assert "gitlab_rails['db_pool'] = 25" in config_lines
+
+
+def test_render_gitlab_rb_overrides(libgitlab):
+    """Test overrides are rendered as Ruby after the managed settings."""
+    libgitlab.charm_config["gitlab_rb_overrides"] = (
+        "gitlab_rails['rate_limit_requests_per_period']: 20\n"
+        "gitlab_workhorse['api_limit']: 100\n"
+        "gitlab_workhorse['env']: {GOGC: '200', NOTE: 'a #{b} \"c\"'}\n"
+        "gitlab_rails['trusted_proxies']: ['10.0.0.0/8']\n"
+        "gitlab_rails['gitlab_default_can_create_group']: false\n"
+    )
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['rate_limit_requests_per_period'] = 20" in config_lines
+    assert "gitlab_workhorse['api_limit'] = 100" in config_lines
+    assert (
+        'gitlab_workhorse[\'env\'] = {"GOGC" => "200", "NOTE" => "a \\#{b} \\"c\\""}'
+        in config_lines
+    )
+    assert "gitlab_rails['trusted_proxies'] = [\"10.0.0.0/8\"]" in config_lines
+    assert "gitlab_rails['gitlab_default_can_create_group'] = false" in config_lines
+    reference = config_lines.index("##            Reference Configuration Settings for GitLab CE and EE           ##")
+    assert config_lines.index("gitlab_workhorse['api_limit'] = 100") < reference
+
+
+@pytest.mark.parametrize(
+    "overrides,error",
+    [
+        ("gitlab_rails['no_such_setting']: 1", "unknown keys: gitlab_rails['no_such_setting']"),
+        ("gitlab_rails['db_host']: other", "keys managed by the charm: gitlab_rails['db_host']"),
+        ("gitlab_rails['env']: [", "not valid YAML"),
+        ("- gitlab_rails['env']", "must be a map"),
+    ],
+)
+def test_invalid_gitlab_rb_overrides(libgitlab, overrides, error):
+    """Test invalid overrides block the unit without rendering gitlab.rb."""
+    _configure_database("pgsql", libgitlab)
+    libgitlab.charm_config["gitlab_rb_overrides"] = overrides
+    with pytest.raises(ValueError, match=re.escape(error)) as excinfo:
+        libgitlab.get_gitlab_rb_overrides()
+    assert libgitlab.render_config() is False
+    assert not os.path.exists(libgitlab.gitlab_config)
+    assert libgitlab.get_config_error() == str(excinfo.value)
+    assert libgitlab.configure() is False
+
+
+def test_gitlab_rb_override_keys(libgitlab):
+    """Test keys missing from the reference gitlab.rb are accepted once listed in gitlab_rb_override_keys."""
+    libgitlab.charm_config["gitlab_rb_overrides"] = "gitaly['configuration']: {graceful_restart_timeout: 1m}"
+    with pytest.raises(ValueError, match="unknown keys"):
+        libgitlab.get_gitlab_rb_overrides()
+    libgitlab.charm_config["gitlab_rb_override_keys"] = "gitaly['configuration'] gitaly['other']"
+    assert libgitlab.get_gitlab_rb_overrides() == [
+        ("gitaly['configuration']", '{"graceful_restart_timeout" => "1m"}')
+    ]
+    # settings managed by the charm are still rejected
+    libgitlab.charm_config["gitlab_rb_overrides"] = "gitlab_rails['db_host']: other"
+    libgitlab.charm_config["gitlab_rb_override_keys"] = "gitlab_rails['db_host']"
+    with pytest.raises(ValueError, match="managed by the charm"):
+        libgitlab.get_gitlab_rb_overrides()
+
+
+def test_get_rails_env(libgitlab):
+    """Test the Ruby runtime options are merged over ruby_env and validated."""
+    assert libgitlab.get_rails_env() is None
+    libgitlab.charm_config["ruby_env"] = "RUBY_GC_HEAP_GROWTH_FACTOR: 1.5\nRUBY_GC_HEAP_OLDOBJECT_LIMIT_FACTOR: 1.2\n"
+    libgitlab.charm_config["ruby_gc_heap_growth_factor"] = "1.1"
+    libgitlab.charm_config["ruby_gc_heap_init_slots"] = 600000
+    libgitlab.charm_config["jemalloc_conf"] = "dirty_decay_ms:1000,muzzy_decay_ms:1000"
+    assert libgitlab.get_rails_env() == (
+        '{"MALLOC_CONF" => "dirty_decay_ms:1000,muzzy_decay_ms:1000", '
+        '"RUBY_GC_HEAP_GROWTH_FACTOR" => "1.1", "RUBY_GC_HEAP_INIT_SLOTS" => "600000", '
+        '"RUBY_GC_HEAP_OLDOBJECT_LIMIT_FACTOR" => "1.2"}'
+    )
+    for ruby_env in ("[", "- RUBY_GC_HEAP_INIT_SLOTS", "ruby_gc: 1"):
+        libgitlab.charm_config["ruby_env"] = ruby_env
+        with pytest.raises(ValueError):
+            libgitlab.get_rails_env()
+
+
+def test_render_rails_env(libgitlab):
+    """Test the Ruby runtime environment is only rendered when set, merged with overrides, and validated."""
+    assert not any(line.startswith("gitlab_rails['env']") for line in _rendered_config("pgsql", libgitlab))
+    libgitlab.charm_config["malloc_arena_max"] = 2
+    assert "gitlab_rails['env'] = {\"MALLOC_ARENA_MAX\" => \"2\"}" in _rendered_config("pgsql", libgitlab)
+    libgitlab.charm_config["gitlab_rb_overrides"] = "gitlab_rails['env']: {http_proxy: 'http://proxy:3128'}"
+    assert (
+        "gitlab_rails['env'] = {\"MALLOC_ARENA_MAX\" => \"2\", \"http_proxy\" => \"http://proxy:3128\"}"
+        in _rendered_config("pgsql", libgitlab)
+    )
+    libgitlab.charm_config["malloc_arena_max"] = 0
+    assert "gitlab_rails['env'] = {\"http_proxy\" => \"http://proxy:3128\"}" in _rendered_config("pgsql", libgitlab)
+    libgitlab.charm_config["gitlab_rb_overrides"] = "gitlab_rails['env']: [http_proxy]"
+    assert libgitlab.render_config() is False
+    libgitlab.charm_config["gitlab_rb_overrides"] = ""
+    libgitlab.charm_config["ruby_env"] = "["
+    assert libgitlab.render_config() is False
+
+
+def test_repository_storages(libgitlab, monkeypatch):
+    """Test attached repositories volumes are rendered as shards, taking new repositories from the root disk."""
+    assert not any(line.startswith("git_data_dirs") for line in _rendered_config("pgsql", libgitlab))
+    assert libgitlab.get_repository_storage_weights() == {"default": 100}
+    locations = {"repositories/1": "/srv/repositories/1", "repositories/2": "/srv/repositories/2"}
+    monkeypatch.setattr("libgitlab.hookenv.storage_get", lambda attribute, storage_id: locations[storage_id])
+    libgitlab.attach_repository_storage("repositories/2")
+    libgitlab.attach_repository_storage("repositories/1")
+    config_lines = [line for line in _rendered_config("pgsql", libgitlab) if line]
+    start = config_lines.index("git_data_dirs({")
+    assert config_lines[start + 1:start + 5] == [
+        '  "default" => { "path" => "/var/opt/gitlab/git-data" },',
+        '  "repositories-1" => { "path" => "/srv/repositories/1" },',
+        '  "repositories-2" => { "path" => "/srv/repositories/2" },',
+        "})",
+    ]
+    assert libgitlab.get_repository_storage_weights() == {"default": 0, "repositories-1": 100, "repositories-2": 100}
+    libgitlab.charm_config["repository_storage_weights"] = "repositories-1: 50"
+    assert libgitlab.get_repository_storage_weights()["repositories-1"] == 50
+    libgitlab.detach_repository_storage("repositories/1")
+    libgitlab.detach_repository_storage("repositories/3")
+    assert [name for name, _ in libgitlab.get_repository_storages()] == ["default", "repositories-2"]
+
+
+def test_data_storages(libgitlab, monkeypatch):
+    """Test attached data volumes move their data class onto them, and back when detached."""
+    locations = {"lfs/3": "/srv/gitlab/lfs-objects", "backups/4": "/var/opt/gitlab/backups"}
+    monkeypatch.setattr("libgitlab.hookenv.storage_get", lambda attribute, storage_id: locations[storage_id])
+    libgitlab.attach_data_storage("lfs/3")
+    libgitlab.attach_data_storage("backups/4")
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['lfs_storage_path'] = \"/srv/gitlab/lfs-objects\"" in config_lines
+    assert "gitlab_rails['backup_path'] = \"/var/opt/gitlab/backups\"" in config_lines
+    assert not any(line.startswith("gitlab_rails['artifacts_path']") for line in config_lines)
+    libgitlab.detach_data_storage("lfs/3")
+    libgitlab.detach_data_storage("artifacts/5")
+    assert libgitlab.get_data_storages() == [("gitlab_rails['backup_path']", "/var/opt/gitlab/backups")]
+
+
+@pytest.mark.parametrize(
+    "weights,error",
+    [
+        ("[", "not valid YAML"),
+        ("default: 200", "weights from 0 to 100"),
+        ("repositories-9: 10", "unknown storages: repositories-9"),
+        ("default: 0", "no storage for new repositories"),
+    ],
+)
+def test_invalid_repository_storage_weights(libgitlab, weights, error):
+    """Test invalid weights block the unit without rendering gitlab.rb."""
+    _configure_database("pgsql", libgitlab)
+    libgitlab.charm_config["repository_storage_weights"] = weights
+    with pytest.raises(ValueError, match=re.escape(error)):
+        libgitlab.get_repository_storage_weights()
+    assert libgitlab.render_config() is False
+    assert libgitlab.update_application_settings() is False
+
+
+def test_update_application_settings(libgitlab, mock_gitlab_subprocess):
+    """Test application settings are only applied through Rails when they change."""
+    # weights set in GitLab are left alone without repositories volumes or configured weights
+    assert libgitlab.update_application_settings() is False
+    mock_gitlab_subprocess.check_output.assert_not_called()
+    libgitlab.charm_config["repository_storage_weights"] = "default: 100"
+    assert libgitlab.update_application_settings() is True
+    script = mock_gitlab_subprocess.check_output.call_args[0][0][-1]
+    assert script == (
+        'ApplicationSetting.current_without_cache.update!({"repository_storages_weighted" => {"default" => 100}})'
+    )
+    mock_gitlab_subprocess.check_output.reset_mock()
+    assert libgitlab.update_application_settings() is False
+    mock_gitlab_subprocess.check_output.assert_not_called()
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_gitlab_subprocess.check_output.side_effect = subprocess.CalledProcessError(1, "gitlab-rails")
+    libgitlab.kv.unset("application_settings")
+    assert libgitlab.update_application_settings() is False
+    assert libgitlab.kv.get("application_settings") is None
+
+
+def test_housekeeping_settings(libgitlab):
+    """Test housekeeping periods are applied as application settings, and the window renders Gitaly maintenance."""
+    assert "housekeeping_gc_period" not in libgitlab.get_application_settings()
+    libgitlab.charm_config["housekeeping_gc_period"] = 100
+    assert libgitlab.get_application_settings()["housekeeping_gc_period"] == 100
+    assert not any(line.startswith("gitaly['daily_maintenance") for line in _rendered_config("pgsql", libgitlab))
+    libgitlab.charm_config["housekeeping_window"] = "22:30-02:00"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitaly['daily_maintenance_start_hour'] = 22" in config_lines
+    assert "gitaly['daily_maintenance_start_minute'] = 30" in config_lines
+    assert "gitaly['daily_maintenance_duration'] = \"210m\"" in config_lines
+    assert "gitaly['daily_maintenance_storages'] = [\"default\"]" in config_lines
+    # GitLab 16.0 dropped the flat gitaly keys
+    libgitlab.get_gitlab_version.return_value = (16, 5)
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitaly['configuration'][:daily_maintenance] = {" in config_lines
+    assert "  start_hour: 22," in config_lines
+    assert "  duration: \"210m\"," in config_lines
+    assert "  storages: [\"default\"]," in config_lines
+    assert not any(line.startswith("gitaly['daily_maintenance") for line in config_lines)
+    libgitlab.get_gitlab_version.return_value = (13, 4)
+    for window in ("01:00", "25:00-02:00", "01:00-01:00"):
+        libgitlab.charm_config["housekeeping_window"] = window
+        with pytest.raises(ValueError):
+            libgitlab.get_housekeeping_window()
+    assert libgitlab.render_config() is False
+
+
+def test_run_housekeeping(libgitlab, mock_gitlab_subprocess, tmpdir):
+    """Test housekeeping is scheduled for all projects by one Rails runner."""
+    libgitlab.housekeeping_script = str(tmpdir.join("housekeeping.rb"))
+    mock_gitlab_subprocess.check_output.return_value = (
+        b"warning\n" b'{"group/a": "scheduled", "group/b": "not found"}\n'
+    )
+    assert libgitlab.run_housekeeping(["group/a", "group/b", "group/c"]) == {
+        "scheduled": "group/a",
+        "failed": "group/b: not found; group/c: no result",
+    }
+    assert mock_gitlab_subprocess.check_output.call_count == 1
+    with open(libgitlab.housekeeping_script) as script:
+        assert 'PROJECTS = ["group/a", "group/b", "group/c"].freeze' in script.read()
+
+
+def test_render_components(libgitlab):
+    """Test optional components default to off, and are only mentioned when GitLab supports them."""
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_pages['enable'] = false" in config_lines
+    assert "registry['enable'] = false" in config_lines
+    assert "mattermost['enable'] = false" in config_lines
+    assert "prometheus['enable'] = false" in config_lines
+    assert "grafana['enable'] = false" in config_lines
+    assert not any(line.startswith("gitlab_kas") for line in config_lines)
+
+    libgitlab.get_gitlab_version.return_value = (16, 5)
+    libgitlab.charm_config["enable_registry"] = True
+    libgitlab.charm_config["registry_external_url"] = "https://registry.example.com"
+    libgitlab.charm_config["enable_monitoring"] = True
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "registry['enable'] = true" in config_lines
+    assert "registry_external_url 'https://registry.example.com'" in config_lines
+    assert "gitlab_kas['enable'] = false" in config_lines
+    assert "prometheus['enable'] = true" in config_lines
+    assert "gitlab_exporter['enable'] = true" in config_lines
+    assert not any(line.startswith("grafana") for line in config_lines)
+
+
+def test_stop_disabled_services(libgitlab, mock_gitlab_subprocess):
+    """Test services of disabled components left running by reconfigure are stopped."""
+    libgitlab.charm_config["enable_registry"] = True
+    libgitlab.get_service_status = mock.Mock(
+        return_value={
+            "puma": "run",
+            "registry": "run",
+            "mattermost": "run",
+            "prometheus": "down",
+            "redis-exporter": "run",
+            "gitlab-exporter": "run",
+        }
+    )
+    libgitlab.stop_disabled_services()
+    commands = [c[0][0] for c in mock_gitlab_subprocess.check_output.call_args_list]
+    assert commands == [
+        ["/usr/bin/gitlab-ctl", "stop", "gitlab-exporter"],
+        ["/usr/bin/gitlab-ctl", "stop", "mattermost"],
+        ["/usr/bin/gitlab-ctl", "stop", "redis-exporter"],
+    ]
+
+
 def test_render_mysql_config(libgitlab):
     """Test render of configuration includes MySQL configuration when present in KV store."""
     _rendered_config("mysql", libgitlab)
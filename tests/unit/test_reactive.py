@@ -0,0 +1,60 @@
+"""Test the reactive handlers of the charm layer."""
+import imp
+import sys
+
+import mock
+import pytest
+
+
+@pytest.fixture
+def layer_gitlab(libgitlab, monkeypatch):
+    """Load the reactive layer with pass-through charms.reactive decorators, driving the mocked helper."""
+    reactive = mock.Mock()
+    for decorator in ("hook", "when", "when_all", "when_any", "when_none", "when_not"):
+        setattr(reactive, decorator, lambda *flags: lambda handler: handler)
+    reactive.endpoint_from_flag.return_value = None
+    monkeypatch.setitem(sys.modules, "charms.reactive", reactive)
+    monkeypatch.setattr("libgitlab.hookenv.atexit", mock.Mock())
+    monkeypatch.setattr("sys.excepthook", mock.Mock())
+    return imp.load_source("layer_gitlab", "./reactive/layer_gitlab.py")
+
+
+def test_invalid_options_stay_blocked(layer_gitlab, libgitlab, mock_open_port, mock_close_port, monkeypatch):
+    """Test invalid options block the unit through configure and later status updates."""
+    mock_status_set = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.status_set", mock_status_set)
+    monkeypatch.setattr("libgitlab.hookenv.hook_name", lambda: "update-status")
+    flags = {"pgsql.database.available"}
+    layer_gitlab.is_flag_set.side_effect = lambda flag: flag in flags
+    libgitlab.kv.set("pgsql_host", "host")
+    libgitlab.kv.set("pgsql_port", "port")
+    libgitlab.kv.set("pgsql_db", "db")
+    libgitlab.kv.set("pgsql_user", "user")
+    libgitlab.kv.set("pgsql_pass", "pass")
+    libgitlab.kv.set("redis_host", "redis")
+    libgitlab.kv.set("redis_port", 6379)
+    libgitlab.charm_config["housekeeping_window"] = "01:00-01:00"
+
+    layer_gitlab.configure_gitlab(None)
+    assert mock_status_set.call_args == mock.call("blocked", "housekeeping_window must not be empty")
+    assert mock.call("active", layer_gitlab.HEALTHY) not in mock_status_set.call_args_list
+    assert not layer_gitlab.set_flag.called
+    assert not mock_open_port.called and not mock_close_port.called
+    assert not libgitlab.gitlab_reconfigure_run.called
+
+    layer_gitlab.update_status_healthy()
+    assert mock_status_set.call_args == mock.call("blocked", "housekeeping_window must not be empty")
+
+    libgitlab.charm_config["housekeeping_window"] = ""
+    layer_gitlab.update_status_healthy()
+    assert mock_status_set.call_args == mock.call("active", layer_gitlab.HEALTHY)
+
+
+def test_hook_outcomes_recorded(layer_gitlab, libgitlab, monkeypatch):
+    """Test hooks are recorded as succeeding on exit, and as failing when they raise."""
+    monkeypatch.setattr("libgitlab.hookenv.hook_name", lambda: "config-changed")
+    layer_gitlab.hookenv.atexit.assert_called_once_with(libgitlab.record_hook, True)
+    error = RuntimeError("hook failed")
+    sys.excepthook(RuntimeError, error, None)
+    metric = libgitlab.kv.get("operation_metrics")["hook:config-changed"]
+    assert metric["outcomes"] == {"success": 0, "failure": 1}